@@ -1,4 +1,11 @@
+from cache import ImageCache
 from forms import FORMS
-from exam import process_exam
-from exam_group import main, process_exam_group, write_exam_group
+from exam import VALIDATION, process_exam, read_exam
+from render import render_validation
+from detect import detect_form
+from exam_group import main, process_exam_group, process_mixed_group, write_exam_group, write_mixed_group
+from batch import main_batch, process_batch
+from cohort import Cohort
+from calibrate import calibrate, calibrate_group
+from service import OmrService, serve
 from gui import Gui
\ No newline at end of file
@@ -0,0 +1,127 @@
+#Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
+"""batch processing of many exam groups through one shared pool
+
+Jobs are (front directory, back directory or None, form) tuples read
+from a manifest csv or found under a root directory (every directory
+containing .jpg images, back sides not paired). The sheets of all jobs
+are scheduled through one pool, longest jobs first, and each job is
+written with write_exam_group as soon as its last sheet is read (and
+merged into the cohort statistics if given). Every job needs a form
+from FORMS (no 'auto' detection). A sheet that cannot be read is logged
+and written as a flagged sheet with no answers (-1), so the other
+sheets and groups are still written.
+
+manifest::
+
+    /scans/class1/front,/scans/class1/back,882E
+    /scans/class2,,882E
+
+"""
+import csv
+import os
+
+from itertools import imap
+from multiprocessing import get_logger
+from os.path import abspath, isfile, join
+from numpy import hstack, vstack
+
+from omr.exam import failed_record, read_exam
+from omr.exam_group import find_images, make_outdir, write_exam_group
+from omr.forms import FORMS
+from omr.render import save_fitdata
+
+LOG = get_logger()
+
+
+def main_batch(path, form, pool=None, validation='none', names=False, cache=None, cohort=None):
+    """run a batch from a manifest csv file or a root directory"""
+    jobs = read_manifest(path, form) if isfile(path) else find_jobs(path, form)
+    return process_batch(jobs, pool, validation, names, cache, cohort)
+
+
+def read_manifest(path, form):
+    """read (front, back, form) jobs from a manifest csv. Back and form
+    columns are optional (default form if empty)"""
+    jobs = []
+    with open(path, 'rb') as f:
+        for row in csv.reader(f):
+            row = [c.strip() for c in row] + ['', '']
+            if row[0] and not row[0].startswith('#'):
+                jobs.append((row[0], row[1] or None, row[2] or form))
+
+    return jobs
+
+
+def find_jobs(root, form):
+    """front side jobs for every directory below root containing .jpg
+    images (OMR output directories excluded)"""
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != 'OMR')
+        if any(f.lower().endswith('.jpg') for f in filenames):
+            jobs.append((dirpath, None, form))
+
+    return jobs
+
+
+def process_batch(jobs, pool=None, validation='none', names=False, cache=None, cohort=None):
+    """Process all sheets of all jobs through one pool, longest jobs
+    first. Write each job's output (and update the cohort) when it
+    completes. Return output directories in completion order."""
+    groups = []
+    for front, back, form in jobs:
+        if form not in FORMS:
+            raise StandardError('batch jobs need a single known form, not {} ({})'.format(form, front))
+
+        dirs = dict([('front', front)] + ([('back', back)] if back else []))
+        images = dict((side, find_images(d)) for side, d in dirs.items())
+        groups.append({'form': form, 'dirs': dirs, 'images': images,
+                       'size': sum(map(len, images.values()))})
+
+    order = sorted(range(len(groups)), key=lambda g: -groups[g]['size'])
+    tasks = []
+    for g in order:
+        for side, testdir in groups[g]['dirs'].items():
+            make_outdir(testdir)
+            formcfg = dict(FORMS[groups[g]['form']][side], cache=cache)
+            tasks += [(g, side, i, imfile, formcfg, validation, names)
+                      for i, imfile in enumerate(groups[g]['images'][side])]
+
+    results = dict((g, dict((side, [None] * len(im)) for side, im in groups[g]['images'].items()))
+                   for g in order)
+    remaining = dict((g, groups[g]['size']) for g in order)
+    done = []
+    for g, side, i, record in (pool.imap_unordered if pool else imap)(_read_task, tasks):
+        results[g][side][i] = record
+        remaining[g] -= 1
+        if not remaining[g]:
+            done.append(_write_group(groups[g], results.pop(g), cohort))
+
+    return done
+
+
+def _read_task(task):
+    """read one sheet of a batch job (failed_record if unreadable)"""
+    g, side, i, imfile, formcfg, validation, names = task
+    try:
+        return g, side, i, read_exam(imfile, formcfg, validation, names)
+    except StandardError, e:
+        LOG.warning('{} failed: {}'.format(imfile, e))
+        return g, side, i, failed_record(formcfg)
+
+
+def _write_group(group, results, cohort=None):
+    """save fit data and write exam group output of a completed job,
+    merge its choices into the cohort"""
+    for side, records in results.items():
+        save_fitdata(join(group['dirs'][side], 'OMR'), group['form'], side, group['images'][side], records)
+
+    choices = hstack([vstack([r['choices'] for r in results[side]])
+                      for side in ['front', 'back'] if side in results])
+    outdir = join(group['dirs']['front'], 'OMR')
+    write_exam_group(group['images']['front'], choices, outdir, [r['name'] for r in results['front']])
+    if cohort is not None:
+        cohort.merge(choices, abspath(outdir))
+        cohort.save()
+
+    return outdir
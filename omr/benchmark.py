@@ -0,0 +1,95 @@
+#Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
+"""throughput of the per sheet and chunked read paths
+
+usage::
+
+    python -m omr.benchmark IMAGEDIR [-f FORM] [-s SIDE] [-k K [K ...]] [-r N] [-p] [-c DIR]
+
+Each chunk size is timed over every image of the directory (best of
+repeat runs, nothing written). Chunk 1 is the per sheet read_exam path,
+larger chunks use read_exams. Every chunk size is run once untimed
+first (warm file, decoded image and pool caches), then each round times
+the chunk sizes in a new random order so run order does not favour any
+size. With --cache the timings exclude jpeg decoding and trimming.
+
+"""
+import argparse
+import multiprocessing
+import random
+import time
+
+from functools import partial
+from itertools import chain
+
+from omr.cache import ImageCache
+from omr.exam import read_exam, read_exams
+from omr.exam_group import find_images
+from omr.forms import FORMS
+
+HEADER = ['chunk', 'images', 'seconds', 'images/s', 'speedup']
+
+
+def benchmark(images, formcfg, chunks=(1, 4, 8, 16), repeat=3, pool=None, seed=0):
+    """time reading all images for each chunk size after one untimed warm
+    up run of each, in a shuffled order every round. Return rows of
+    HEADER (best time, speedup relative to the first chunk size)"""
+    chunks = list(chunks)
+    for chunk in chunks:
+        _time_read(images, formcfg, chunk, pool)
+
+    best = dict((chunk, float('inf')) for chunk in chunks)
+    order = list(chunks)
+    rand = random.Random(seed)
+    for _r in range(repeat):
+        rand.shuffle(order)
+        for chunk in order:
+            best[chunk] = min(best[chunk], _time_read(images, formcfg, chunk, pool))
+
+    base = best[chunks[0]]
+    return [[chunk, len(images), best[chunk], len(images) / best[chunk], base / best[chunk]] for chunk in chunks]
+
+
+def _time_read(images, formcfg, chunk, pool=None):
+    """seconds to read all images in chunks"""
+    start = time.time()
+    if chunk > 1:
+        func = partial(read_exams, formcfg=formcfg)
+        chunks = [images[i:i + chunk] for i in range(0, len(images), chunk)]
+        list(chain.from_iterable(pool.map(func, chunks) if pool else map(func, chunks)))
+    else:
+        func = partial(read_exam, formcfg=formcfg)
+        pool.map(func, images) if pool else map(func, images)
+
+    return time.time() - start
+
+
+def main():
+    """run the benchmark from the command line and print the table"""
+    parser = argparse.ArgumentParser(description='Compare per sheet and chunked read throughput.')
+    parser.add_argument('imagedir', help='Image directory')
+    parser.add_argument('-f', '--form', default='882E', choices=FORMS.keys())
+    parser.add_argument('-s', '--side', default='front', choices=['front', 'back'])
+    parser.add_argument('-k', '--chunks', default=[1, 4, 8, 16], type=int, nargs='+', metavar='K',
+                        help='Chunk sizes (first is the baseline, default 1 4 8 16)')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='Runs per chunk size (best kept)')
+    parser.add_argument('-p', '--pool', action='store_true', help='Use a processing pool')
+    parser.add_argument('-c', '--cache', default=None, metavar='DIR', help='Decoded image cache directory')
+    args = parser.parse_args()
+
+    images = find_images(args.imagedir)
+    formcfg = dict(FORMS[args.form][args.side], cache=ImageCache(args.cache) if args.cache else None)
+    pool = multiprocessing.Pool() if args.pool else None
+    rows = benchmark(images, formcfg, args.chunks, args.repeat, pool)
+    print '{} images, form {} {}, pool {}, cache {}'.format(len(images), args.form, args.side,
+                                                            bool(pool), bool(args.cache))
+    print ''.join('{:>10}'.format(h) for h in HEADER)
+    for row in rows:
+        print '{:>10d}{:>10d}{:>10.3f}{:>10.2f}{:>10.2f}'.format(*row)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    main()
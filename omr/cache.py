@@ -0,0 +1,100 @@
+#Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
+"""decoded image cache for fast re-analysis
+
+Trimmed greyscale pages are stored as uint8 .npy files keyed by the
+image file hash, dpi and trim_std, and are read back as copy on write
+memory maps, so later analysis passes (threshold tuning, calibration)
+skip jpeg decoding, dpi resize and margin trimming. The cache directory
+is limited to max_bytes, least recently used pages are evicted first.
+
+"""
+import hashlib
+import os
+import numpy as num
+
+from glob import glob
+from os.path import exists, getmtime, getsize, join
+
+
+class ImageCache(object):
+    """Decoded image cache directory
+
+
+    path
+        cache directory (created if missing)
+
+    max_bytes
+        cache size limit in bytes
+
+    """
+
+    def __init__(self, path, max_bytes=2 ** 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not exists(path):
+            os.makedirs(path)
+
+    def key(self, imfile, dpi, trim_std):
+        """cache key from image file contents and decoding parameters"""
+        sha = hashlib.sha1()
+        with open(str(imfile), 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), ''):
+                sha.update(block)
+
+        sha.update(repr((list(dpi), trim_std)))
+        return sha.hexdigest()
+
+    def load(self, imfile, dpi, trim_std, loader):
+        """return the cached page for an image or store and return loader()"""
+        key = self.key(imfile, dpi, trim_std)
+        img = self.get(key)
+        if img is None:
+            img = self.put(key, loader())
+
+        return img
+
+    def get(self, key):
+        """return cached page as a copy on write memory map or None"""
+        npy = join(self.path, key + '.npy')
+        try:
+            img = num.load(npy, mmap_mode='c')
+            os.utime(npy, None)  # mark recently used
+        except (IOError, OSError, ValueError):  # missing or evicted
+            return None
+
+        return img
+
+    def put(self, key, img):
+        """store page (uint8), evict least recently used pages over the
+        size limit, return the page"""
+        npy = join(self.path, key + '.npy')
+        tmp = '{}.{}.tmp'.format(npy, os.getpid())
+        with open(tmp, 'wb') as f:
+            num.save(f, num.asarray(img, 'uint8'))
+
+        try:
+            os.rename(tmp, npy)  # atomic for concurrent workers
+        except OSError:  # windows: already stored by another worker
+            os.remove(tmp)
+        self.evict(keep=npy)
+        return img
+
+    def evict(self, keep=None):
+        """remove least recently used pages until under max_bytes"""
+        try:
+            pages = sorted((getmtime(p), getsize(p), p) for p in glob(join(self.path, '*.npy')))
+        except OSError:  # removed by another worker while listing
+            return
+
+        total = sum(size for _t, size, _p in pages)
+        for _mtime, size, npy in pages:
+            if total <= self.max_bytes:
+                break
+
+            if npy != keep:
+                try:
+                    os.remove(npy)
+                except OSError:
+                    pass
+
+                total -= size
@@ -0,0 +1,263 @@
+#Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
+"""threshold calibration for new scanners and forms
+
+A sample of sheets is decoded once (through the decoded image cache if
+given) and a grid of threshold settings is evaluated on the greyscale
+pages. Reference box fits are computed once per contrast for every
+shift in the search radius, bubble means once per (contrast, min_ref)
+offset, and every signal value in one vectorized comparison.
+
+================  ==========================================================
+Column            Description
+================  ==========================================================
+trim_std          chosen edge trimming stdev (fewest size check failures)
+contrast          black/white contrast split value
+min_ref           maximum mean value for a reference box match
+signal            minimum ratio of darkest to second darkest choice
+ambiguous         fraction of -1 choices on readable sheets
+ref_missed        fraction of unmatched reference boxes
+failed            fraction of unreadable sheets (size check or no box match)
+agreement         fraction of choices equal to the key (nan without key)
+================  ==========================================================
+
+The suggested setting maximizes agreement, then minimizes failed sheets,
+missed boxes and ambiguous choices, preferring values closest to the
+current form. Without a key the current signal is kept.
+
+"""
+import numpy as num
+import yaml
+
+from functools import partial
+from os.path import join
+
+from omr.detect import trim_thumbnail
+from omr.exam import Form, rect_means, shifted_means, summed_area
+from omr.exam_group import find_images, make_outdir
+from omr.forms import FORMS
+
+GRID = {
+    'trim_std': [2, 4, 8, 16],
+    'contrast': range(112, 240, 16),
+    'min_ref': range(64, 224, 32),
+    'signal': [1.05, 1.1, 1.2, 1.3, 1.5, 2.0],
+}
+"""default threshold grid (the current form values are always added)"""
+
+HEADER = ['trim_std', 'contrast', 'min_ref', 'signal', 'ambiguous', 'ref_missed', 'failed', 'agreement']
+
+
+def calibrate_group(testdir, formstr, side, key=None, sample=20, pool=None, cache=None, grid=None):
+    """Calibrate form thresholds on a sample of a test image directory.
+    Write OMR/calibration.csv and OMR/calibration.yaml, return the
+    suggested forms.yaml text.
+
+
+    key
+        expected choices of the first image (questions,) or of every
+        image (n, questions), or the path of such a csv file (e.g. a
+        checked choices.csv). The side's columns are taken from a front
+        and back csv (front questions first).
+
+    sample
+        number of evenly spaced images evaluated (first image included)
+
+    """
+    if isinstance(key, basestring):
+        key = _side_columns(num.loadtxt(key, delimiter=',', dtype='i'), formstr, side)
+
+    images = find_images(testdir)
+    index = range(0, len(images), max(1, len(images) // sample))[:sample]
+    if key is not None and num.ndim(key) == 2:
+        key = num.asarray(key)[index]
+
+    rows, suggestion = calibrate([images[i] for i in index], formstr, side, key, pool, cache, grid)
+
+    outdir = make_outdir(testdir, clean=False)
+    num.savetxt(join(outdir, 'calibration.csv'), rows, fmt='%g', delimiter=',', header=','.join(HEADER))
+    text = yaml.safe_dump({formstr: {side: suggestion}}, default_flow_style=None)
+    with open(join(outdir, 'calibration.yaml'), 'w') as f:
+        f.write(text)
+
+    return text
+
+
+def calibrate(images, formstr, side, key=None, pool=None, cache=None, grid=None):
+    """Evaluate a grid of threshold settings on sample images. Return
+    result table (rows of HEADER) and suggested form specification."""
+    if formstr not in FORMS:
+        raise StandardError('calibration needs a single known form, not {}'.format(formstr))
+
+    formcfg = FORMS[formstr][side]
+    questions = Form(**formcfg).grid_shape[0]
+    if key is not None and num.shape(key)[-1] != questions:
+        raise StandardError('key has {} questions, form {} {} has {}'
+                            .format(num.shape(key)[-1], formstr, side, questions))
+
+    grid = dict(GRID, **(grid or {}))
+    grid = dict((k, sorted(set(v) | set([formcfg[k]] if k in formcfg else []))) for k, v in grid.items())
+
+    func = partial(load_page, formcfg=formcfg, cache=cache)
+    pages = pool.map(func, images) if pool else map(func, images)
+    trim_std, pages, sizefail = trim_pages(pages, formcfg, grid['trim_std'])
+    form = Form(**dict(formcfg, trim_std=trim_std))
+
+    rows = []
+    for contrast in grid['contrast']:
+        sats = [summed_area(255 * (img >= contrast)) for img in pages]
+        minmean, shift = reference_fits(sats, form)
+        for min_ref in grid['min_ref']:
+            matched = minmean <= min_ref
+            means, reffail = bubble_means(sats, formcfg, shift, matched)
+            failed = sizefail | reffail
+            ambiguous, agreement = score_signals(means, failed, grid['signal'], key)
+            missed = 1 - matched.mean() if matched.size else 0.0
+            rows += [[trim_std, contrast, min_ref, signal, amb, missed, failed.mean(), agree]
+                     for signal, amb, agree in zip(grid['signal'], ambiguous, agreement)]
+
+    rows = num.array(rows)
+    return rows, suggest(rows, formcfg, key is not None)
+
+
+def load_page(imfile, formcfg, cache=None):
+    """decoded greyscale page at form dpi (not trimmed)"""
+    form = Form(**formcfg)
+    if cache:
+        return cache.load(imfile, form.expected_dpi, None, lambda: form._load_image(imfile))
+
+    return form._load_image(imfile)
+
+
+def trim_pages(pages, formcfg, values):
+    """choose the trim_std with fewest size check failures (closest to
+    the form value on ties). Return trim_std, trimmed pages and size
+    failure flags. Pages trimmed to nothing (blank) fail and are
+    replaced by a white page."""
+    form = Form(**formcfg)
+    fails = [sum(not _size_ok(form, trim_thumbnail(img, t)) for img in pages) for t in values]
+    trim_std = min(zip(fails, [abs(t - form.trim_std) for t in values], values))[2]
+
+    form.trim_std = trim_std
+    trimmed, failed = [], []
+    for img in pages:
+        try:
+            img = form._trim_margins(img)
+        except IndexError:  # blank page
+            trimmed.append(num.full(form.expected_size, 255, 'uint8'))
+            failed.append(True)
+        else:
+            trimmed.append(img)
+            failed.append(not _size_ok(form, img))
+
+    return trim_std, trimmed, num.array(failed, bool)
+
+
+def reference_fits(sats, form):
+    """best shift and its mean for every page and reference box within
+    the circular search radius. Return (n, refzones) means and
+    (n, refzones, 2) shifts"""
+    refzone = form.refzone or []
+    r = form.radius
+    di, dj = num.meshgrid(num.arange(-r, r + 1), num.arange(-r, r + 1), indexing='ij')
+    allowed = (di < r) & (dj < r) & (di ** 2 + dj ** 2 <= r ** 2)  # as center_on_box
+
+    minmean = num.zeros((len(sats), len(refzone)))
+    shift = num.zeros((len(sats), len(refzone), 2), 'i')
+    for p, sat in enumerate(sats):
+        for k, ref in enumerate(refzone):
+            means = num.where(allowed, shifted_means(sat, r, *ref), num.inf)
+            best = num.argmin(means)
+            minmean[p, k] = means.flat[best]
+            shift[p, k] = di.flat[best], dj.flat[best]
+
+    return minmean, shift
+
+
+def bubble_means(sats, formcfg, shift, matched):
+    """answer bubble means of every page at the mean matched reference
+    shift, corrected by the affine reference fit as Form.fit_reference.
+    Return (n, questions, choices) means and reference failure flags (no
+    box matched)"""
+    forms = {}
+    means, failed = [], []
+    for sat, sh, ok in zip(sats, shift, matched):
+        offset = (0, 0)
+        if len(ok):
+            offset = tuple(num.mean(sh[ok], axis=0).astype('i')) if ok.any() else (0, 0)
+
+        if offset not in forms:
+            forms[offset] = Form(**formcfg)
+            forms[offset]._set_offset(*offset)
+
+        form = forms[offset]
+        transform = form._get_affine_fit(offset, num.where(ok[:, None], sh, -9999)) if len(ok) else None
+        if transform is not None:
+            form = Form(**formcfg)
+            form._set_offset(*offset)
+            form._set_transform(transform)
+
+        means.append(form.grid_means(rect_means(sat, form.coords)))
+        failed.append(len(ok) > 0 and not ok.any())
+
+    return num.array(means), num.array(failed, bool)
+
+
+def score_signals(means, failed, signals, key=None):
+    """ambiguous choice rate and key agreement for each signal value"""
+    choice = num.argmin(means, axis=2)
+    ordered = num.sort(means, axis=2)
+    with num.errstate(divide='ignore', invalid='ignore'):
+        ratio = ordered[..., 1] / ordered[..., 0]
+
+    unclear = ratio[None] <= num.array(signals)[:, None, None]  # (signals, n, questions)
+    choices = num.where(unclear, -1, choice[None])
+    readable = ~num.asarray(failed, bool)
+    ambiguous = unclear[:, readable].reshape(len(signals), -1).mean(axis=1) if readable.any() \
+        else num.ones(len(signals))
+
+    if key is None:
+        return ambiguous, num.repeat(num.nan, len(signals))
+
+    key = num.asarray(key)
+    rows = [0] if key.ndim == 1 else range(len(key))
+    agree = (choices[:, rows] == key.reshape(len(rows), -1)) & readable[rows][None, :, None]
+    return ambiguous, agree.reshape(len(signals), -1).mean(axis=1)
+
+
+def suggest(rows, formcfg, keyed=False):
+    """suggested form specification from the calibration table"""
+    names = ['trim_std', 'contrast', 'min_ref', 'signal']
+    current = num.array([formcfg.get(k, 0) for k in names], 'd')
+    if not keyed:
+        rows = rows[rows[:, 3] == current[3]]
+
+    distance = num.sum(num.abs(rows[:, :4] - current) / num.maximum(current, 1), axis=1)
+    agreement = num.nan_to_num(rows[:, 7])
+    best = rows[num.lexsort((distance, rows[:, 4], rows[:, 5], rows[:, 6], -agreement))[0]]
+
+    suggestion = dict(formcfg)
+    suggestion.update((k, int(v) if k != 'signal' else float(v)) for k, v in zip(names, best[:4]))
+    return suggestion
+
+
+def _side_columns(key, formstr, side):
+    """key columns of one side from a front and back choice matrix
+    (front questions first, back questions last)"""
+    if formstr not in FORMS:
+        return key
+
+    questions = Form(**FORMS[formstr][side]).grid_shape[0]
+    if key.shape[-1] <= questions:
+        return key
+
+    return key[..., :questions] if side == 'front' else key[..., -questions:]
+
+
+def _size_ok(form, img):
+    """image dimensions within form size tolerance"""
+    try:
+        form._check_size(img)
+    except StandardError:
+        return False
+
+    return True
@@ -0,0 +1,137 @@
+#Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
+"""incremental cohort statistics across many exam groups
+
+Each exam group's choice matrix is merged into running per question
+totals as soon as it is written, and the totals are kept in
+<path>/cohort.npz between runs. Memory is bounded by the number of
+questions, not the number of students. Groups are scored against their
+own key (first test, excluded from the totals) as in write_exam_group,
+and a group already merged (same output directory) is skipped.
+
+state arrays::
+
+    groups         (g,) merged group names
+    key            (questions,) key of the first merged group
+    counts         (questions, choices + 1) choice frequency (-1 first)
+    correct        (questions,) correct count
+    score_correct  (questions,) sum of the total score of correct tests
+    scores         (questions + 1,) total score histogram
+
+Reports written to path on save::
+
+    questioninfo.csv   Question, Key, CorrectCount, Difficulty,
+                       Discrimination, None(-1), A(0), B(1), ...
+    scores.csv         Score, Count
+
+Difficulty is the fraction of correct tests and discrimination the point
+biserial correlation of the question with the total score.
+
+"""
+import os
+import numpy as num
+
+from os.path import exists, join
+
+from omr.exam_group import choice_header, score_exam_group
+
+STATE = ['groups', 'key', 'counts', 'correct', 'score_correct', 'scores']
+
+
+class Cohort(object):
+    """Running cohort statistics stored in a directory
+
+
+    path
+        cohort directory (created if missing, state loaded if present)
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.groups = []
+        self.key = self.counts = self.correct = self.score_correct = self.scores = None
+        if not exists(path):
+            os.makedirs(path)
+
+        npz = join(path, 'cohort.npz')
+        if exists(npz):
+            with num.load(npz) as f:
+                self.__dict__.update((k, f[k]) for k in STATE)
+            self.groups = list(self.groups)
+
+    @property
+    def size(self):
+        """number of merged tests (keys excluded)"""
+        return 0 if self.scores is None else int(self.scores.sum())
+
+    def merge(self, choices, name):
+        """add a group choice matrix (tests in rows, key first). Return
+        False if the group was already merged."""
+        if name in self.groups:
+            return False
+
+        choices = num.asarray(choices)
+        if self.key is None:
+            self._reset(choices[0])
+        elif choices.shape[1] != len(self.key):
+            raise StandardError('cohort has {} questions, group {} has {}'
+                                .format(len(self.key), name, choices.shape[1]))
+
+        scoring, score_by_test, score_by_question = score_exam_group(choices)
+        tests = choices[1:]
+        width = max(self.counts.shape[1], tests.max() + 2 if tests.size else 0)
+        pad = num.zeros((len(self.key), width - self.counts.shape[1]), 'int64')
+        self.counts = num.hstack((self.counts, pad))
+
+        for q in range(tests.shape[1]):
+            self.counts[q] += num.bincount(tests[:, q] + 1, minlength=width)
+
+        self.correct += score_by_question
+        self.score_correct += num.dot(score_by_test[1:], scoring[1:].astype('i'))
+        self.scores += num.bincount(score_by_test[1:], minlength=len(self.scores))
+        self.groups.append(name)
+        return True
+
+    def item_stats(self):
+        """(questions, 5) question number, key, correct count, difficulty
+        and discrimination (nan if undefined)"""
+        n = float(self.size)
+        score = num.arange(len(self.scores))
+        with num.errstate(divide='ignore', invalid='ignore'):
+            p = self.correct / n
+            mean = num.dot(score, self.scores) / n
+            sd = num.sqrt(num.dot(score ** 2, self.scores) / n - mean ** 2)
+            discrimination = (self.score_correct / self.correct.astype('d') - mean) / sd * num.sqrt(p / (1 - p))
+
+        return num.column_stack((num.arange(1, len(self.key) + 1), self.key, self.correct, p, discrimination))
+
+    def save(self):
+        """write cohort.npz (atomically except on windows) and the csv
+        reports"""
+        npz = join(self.path, 'cohort.npz')
+        tmp = '{}.{}.tmp'.format(npz, os.getpid())
+        with open(tmp, 'wb') as f:
+            num.savez(f, **dict((k, num.array(getattr(self, k))) for k in STATE))
+
+        try:
+            os.rename(tmp, npz)
+        except OSError:  # windows does not replace an existing file
+            os.remove(npz)
+            os.rename(tmp, npz)
+
+        header = ['Question', 'Key', 'CorrectCount', 'Difficulty', 'Discrimination']
+        header += choice_header(self.counts.shape[1] - 1)
+        num.savetxt(join(self.path, 'questioninfo.csv'), num.hstack((self.item_stats(), self.counts)),
+                    fmt=['%i'] * 3 + ['%.4f'] * 2 + ['%i'] * self.counts.shape[1], delimiter=',',
+                    header=','.join(header))
+        num.savetxt(join(self.path, 'scores.csv'), num.column_stack((num.arange(len(self.scores)), self.scores)),
+                    fmt='%i', delimiter=',', header='Score,Count')
+
+    def _reset(self, key):
+        """empty totals for a key"""
+        q = len(key)
+        self.key = num.array(key, 'i')
+        self.counts = num.zeros((q, 6), 'int64')
+        self.correct = num.zeros(q, 'int64')
+        self.score_correct = num.zeros(q, 'int64')
+        self.scores = num.zeros(q + 1, 'int64')
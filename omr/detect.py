@@ -0,0 +1,124 @@
+#Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
+"""automatic form detection for mixed form batches
+
+Each registered form side is scored against a small thumbnail of the
+sheet. JPEG thumbnails are decoded with DCT scaling (PIL draft mode) so
+detection costs a fraction of the full resolution pipeline.
+
+score = size error + mean reference box value / 255 (lower is better)
+
+- size error: largest relative difference between trimmed thumbnail
+  size and form expected_size. Form sides outside twice the size
+  tolerance are rejected.
+- reference boxes: mean value of each refzone rectangle scaled onto the
+  thumbnail, best offset within the scaled search radius. Form sides
+  whose mean is above min_ref are rejected.
+
+Sides with identical specifications (the built in 882E front and back)
+always tie. Ties go to the first registered form, then the front side.
+
+"""
+import numpy as num
+
+from PIL import Image
+
+from omr.exam import Form, read_exam, shifted_means, summed_area
+from omr.forms import FORMS
+
+SIDES = ('front', 'back')
+"""side preference on tied scores"""
+
+
+def detect_form(imfile, forms=None, scale=4):
+    """return best matching (form, side) for an image or (None, None)"""
+    thumb, ratio = load_thumbnail(imfile, scale)
+    trimmed = {}
+    scores = [(score_form(thumb, ratio, cfg, trimmed), f, _side_rank(side), formstr, side)
+              for f, (formstr, sides) in enumerate((forms or FORMS).items())
+              for side, cfg in sides.items()]
+    best, _f, _rank, formstr, side = min(scores)
+    if best == num.inf:
+        return None, None
+
+    return formstr, side
+
+
+def _side_rank(side):
+    """tie break order of a side (SIDES first)"""
+    return SIDES.index(side) if side in SIDES else len(SIDES)
+
+
+def process_detected(imfile, forms=None, validation='none', names=False, cache=None):
+    """detect form side then process the image. Return (form, side,
+    read_exam record) or (None, None, None) if no form matches. cache
+    is an optional decoded image cache."""
+    formstr, side = detect_form(imfile, forms)
+    if formstr is None:
+        return None, None, None
+
+    formcfg = dict((forms or FORMS)[formstr][side], cache=cache)
+    return formstr, side, read_exam(imfile, formcfg, validation, names)
+
+
+def load_thumbnail(imfile, scale=4):
+    """load a greyscale thumbnail reduced by about scale. Return the
+    thumbnail array and (h, w) thumbnail pixels per pixel at 1 dpi"""
+    im = Image.open(str(imfile))
+    dpi = num.array(im.info.get('dpi', (0, 0)), 'f')[::-1]
+    size = num.array(im.size)[::-1]
+    if im.format == 'JPEG':
+        im.draft('L', tuple(size[::-1] // scale))  # decode at reduced scale
+    else:
+        im = im.resize(tuple(size[::-1] // scale), Image.BILINEAR)
+
+    im = im.convert('L')
+
+    thumb = num.array(im)
+    return thumb, num.true_divide(thumb.shape, size) * dpi
+
+
+def score_form(thumb, ratio, formcfg, trimmed=None):
+    """score how well a thumbnail matches a form side specification.
+    trimmed caches trimmed thumbnails by trim_std between form sides."""
+    form = Form(**formcfg)
+    if not num.all(ratio):
+        return num.inf
+
+    factor = ratio / num.array(form.expected_dpi, 'f')  # thumb px per form px
+    trimmed = {} if trimmed is None else trimmed
+    if form.trim_std not in trimmed:
+        trimmed[form.trim_std] = trim_thumbnail(thumb, form.trim_std)
+
+    img = trimmed[form.trim_std]
+    sizediff = num.abs(img.shape / factor - form.expected_size) / form.expected_size
+    if num.any(sizediff > 2 * num.array(form.size_tolerance)):
+        return num.inf
+
+    refscore = 1.0  # no reference boxes, size only
+    if form.refzone:
+        rects = (num.array(form.refzone) * num.repeat(factor, 2)).astype('i')
+        r = int(num.ceil(form.radius * num.max(factor)))
+        sat = summed_area(img)
+        refmean = num.mean([num.min(shifted_means(sat, r, *rect)) for rect in rects])
+        if refmean > form.min_ref:
+            return num.inf
+
+        refscore = refmean / 255
+
+    return num.max(sizediff) + refscore
+
+
+def trim_thumbnail(img, trim_std):
+    """trim blank edges (low stdev rows and columns) until the size is
+    stable. Vectorized approximation of Form._trim_margins"""
+    oldsize = (0, 0)
+    while oldsize != img.shape and img.size:
+        oldsize = img.shape
+        rows = num.flatnonzero(num.std(img, axis=1) >= trim_std)
+        cols = num.flatnonzero(num.std(img, axis=0) >= trim_std)
+        if not (rows.size and cols.size):
+            return img[:0, :0]
+
+        img = img[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+    return img
@@ -2,7 +2,6 @@
 """single exam processing"""
 import numpy as num
 
-from itertools import product
 from multiprocessing import get_logger
 from os.path import basename, dirname, join
 from PIL import Image
@@ -10,13 +9,79 @@ from PIL import Image
 LOG = get_logger()
 
 
-def process_exam(imfile, formcfg):
+VALIDATION = ('none', 'flagged', 'all')
+"""validation image modes: no images, flagged sheets only, every sheet"""
+
+
+def process_exam(imfile, formcfg, validation='all', names=True):
     """Process input test image returning answer choices"""
+    return read_exam(imfile, formcfg, validation, names)['choices']
+
+
+def read_exam(imfile, formcfg, validation='none', names=False):
+    """Process input test image returning a record of answer choices, the
+    compact fit data (offset, refzone fits, bubble means) needed to render
+    the validation image later and the name/score image array (or None).
+    Write the name image png if names is True."""
+    _log_image(imfile)
+    form = Form(**formcfg)
+    choices = form.from_file(imfile, validation, names)
+    return _record(form, choices)
+
+
+def read_exams(imfiles, formcfg, validation='none', names=False):
+    """Process a batch of test images returning a list of read_exam
+    records. After the reference fit only the answer bubble crops of
+    each sheet are kept (padded to the largest bubble), and the bubble
+    means and answers of all sheets are computed in single vectorized
+    calls over the stacked crops."""
+    forms, pages = [], []
+    for imfile in imfiles:
+        _log_image(imfile)
+        form = Form(**formcfg)
+        img = form.import_image(imfile)
+        form.fit_reference(img)
+        forms.append(form)
+        pages.append(img)
+
+    coords = num.array([form.coords for form in forms])
+    shape = (coords[..., 1] - coords[..., 0]).max(), (coords[..., 3] - coords[..., 2]).max()
+    crops, masks, areas = map(num.array, zip(*[rect_crops(img, c, shape) for img, c in zip(pages, coords)]))
+    count = num.sum((crops >= forms[0].contrast) & masks, axis=(-2, -1))
+    means = forms[0].grid_means(255.0 * count / num.maximum(areas, 1))
+    choices = forms[0]._choose_answers(means)
+
+    records = []
+    for form, img, imfile, m, c in zip(forms, pages, imfiles, means, choices):
+        form.means = m
+        form.write_outputs(img, imfile, c, validation, names)
+        records.append(_record(form, c))
+
+    return records
+
+
+def failed_record(formcfg):
+    """read_exam record of an unreadable sheet: no answers read, reference
+    boxes unmatched (flagged), blank bubble means and no name image"""
+    form = Form(**formcfg)
+    fit = num.zeros((len(form.refzone), 2), 'i') - 9999 if form.refzone else None
+    means = num.empty(form.grid_shape)
+    means.fill(255.0)
+    return {'choices': -num.ones(form.grid_shape[0], 'i'), 'offset': form.offset, 'fit': fit, 'means': means,
+            'name': None}
+
+
+def _log_image(imfile):
+    """log the image file name"""
     LOG.setLevel(20)
     LOG.info(basename(imfile))
     LOG.setLevel(30)
 
-    return Form(**formcfg).from_file(imfile)
+
+def _record(form, choices):
+    """read_exam record of a processed form"""
+    return {'choices': choices, 'offset': form.offset, 'fit': form.fit, 'means': form.means,
+            'name': form.nameimg}
 
 
 class Form:
@@ -26,7 +91,8 @@ class Form:
     
     - Black reference boxes to be fitted
     - Info box containing written name  
-    - Answer bubble grid: (m, n) grid of answer bubble rectangles 
+    - Answer bubble grid: (m, n) grid of answer bubble rectangles, or a
+      list of grid blocks
     
     Form specification
     ------------------  
@@ -40,7 +106,12 @@ class Form:
     pos               h,w coordinate of answer matrix upper left corner (i0, j0) in pixels
     bub               h,w answer bubble surrounding box in pixels (float ok)         
     space             h,w unit cell edge lengths in pixels (float ok)
+    blocks            list of grids with their own size, pos, bub and space (or None)
     offset            h,w fitted reference offset applied to pos
+    fit               per refzone fitted offsets (-9999 if not matched)
+    transform         fitted affine correction of the coordinates (3, 2) or None
+    means             fitted answer bubble mean values
+    nameimg           extracted name/score image
     ================  ===============================================================================
     
     ::
@@ -61,6 +132,20 @@ class Form:
         |
 
 
+    Grid blocks
+    -----------
+
+    Forms with several answer columns, ID number blocks or sections with
+    different choice counts list each grid under blocks (size, pos, bub and
+    space are then ignored). Questions are numbered block after block and
+    choices are padded to the widest block. All bubbles are kept in one
+    (bubbles, 4) coordinate table, sampled in a single pass and moved by
+    the shared reference offset. ::
+
+        blocks:
+        - {size: [25, 5], pos: [258, 130], space: [25.2, 49.2], bub: [15, 39]}
+        - {size: [10, 10], pos: [258, 400], space: [25.2, 20], bub: [15, 15]}
+
     Region rectangles
     -----------------
 
@@ -89,18 +174,35 @@ class Form:
     min_ref           minimum pixel value for black box match 0<=x<=255
     ref_x, ref_y      validation image reference fit summary panel coordinates
     signal            minimum ratio of darkest to second darkest answer choice    
+    max_skew          maximum affine scale/shear from the reference fit (0 translation only)
+    cache             decoded image cache (ImageCache or None)
     ================  ====================================================================
     
+    Reference fit
+    -------------
+
+    The mean of the matched reference box offsets is applied to pos, info
+    and score. With 3 or more matched boxes, a least squares affine
+    transform of the box centers corrects the remaining skew and scale
+    error by moving the bubble, info and score rectangle centers
+    (rectangle sizes are kept and the image is never resampled). Fits
+    exceeding max_skew fall back to the mean offset.
+    
     """
     size = [0, 0]
     offset = [0, 0]
     pos = [0, 0]
     bub = [0, 0]
     space = [0, 0]
+    blocks = None
 
     info = None
     score = None
     refzone = None
+    fit = None
+    transform = None
+    means = None
+    nameimg = None
 
     expected_dpi = [0, 0]
     expected_size = [0, 0]
@@ -111,69 +213,143 @@ class Form:
     radius = 0
     min_ref = 0.0 * 255
     signal = 0.0
+    max_skew = 0.05
+    cache = None
 
     def __init__(self, **kwargs):
         """initialize form, calculate default coordinates.  """
         self.__dict__.update(kwargs)
+        if not self.blocks:
+            self.blocks = [{'size': self.size, 'pos': self.pos, 'bub': self.bub, 'space': self.space}]
+
+        self.blocks = [dict(b) for b in self.blocks]
         self._calc_coords()
 
-    def from_file(self, imfile):
+    def from_file(self, imfile, validation='all', names=True):
         """process image from file.
 
-        import image, fit reference, read answer choices, write output.
+        import image, fit reference, read answer choices, extract name
+        image, write output. validation is one of VALIDATION. names
+        writes the name image png.
         """
         img = self.import_image(imfile)
-        img = self.fit_reference(img)
-        img, choices = self.get_choices(img)
-        self.write_validation(img, imfile)
+        self.fit_reference(img)
+        choices = self.get_choices(img)
+        self.write_outputs(img, imfile, choices, validation, names)
         return choices
 
+    def write_outputs(self, img, imfile, choices, validation='all', names=True):
+        """extract the name image, write the name image png and the
+        validation image as requested"""
+        self.nameimg = self.get_info_image(img)
+        if names and self.nameimg is not None:
+            self._save_info_image(self.nameimg, imfile)
+
+        if validation == 'all' or (validation == 'flagged' and self.is_flagged(choices)):
+            self.write_validation(img, imfile)
+
     def import_image(self, imfile):
-        """load image, check dpi, trim margins, check size fit image reference boxes"""
-        img = self._load_image(imfile)
-        img = self._trim_margins(img)
+        """load image, check dpi, trim margins, check size fit image reference boxes.
+        Read and store the trimmed image in the decoded image cache if set."""
+        if self.cache:
+            img = self.cache.load(imfile, self.expected_dpi, self.trim_std,
+                                  lambda: self._trim_margins(self._load_image(imfile)))
+        else:
+            img = self._load_image(imfile)
+            img = self._trim_margins(img)
+
         self._check_size(img)
         return img
 
     def fit_reference(self, img):
-        """fit the reference boxes and draw fit validation"""
+        """fit the reference boxes and apply the mean offset"""
         if self.refzone:
-            meanfit, fit = self._get_reference_fit(img)
-            img = self._overlay_ref_fit(img, meanfit, fit)
+            meanfit, self.fit = self._get_reference_fit(img)
             self._set_offset(*meanfit)
-
-        return img
+            self._set_transform(self._get_affine_fit(meanfit, self.fit))
 
     def get_choices(self, img):
-        """read answer choices and overlay validation"""
-        means = self._get_bubble_means(img)
-        choices = self._choose_answers(means)
-        img = self._overlay_bubble_means(img, means)
-        return img, choices
+        """read answer choices"""
+        self.means = self._get_bubble_means(img)
+        return self._choose_answers(self.means)
+
+    def get_info_image(self, img):
+        """extract the rotated info box region and stack the score box"""
+        if self.info is None or not len(self.info):
+            return None
+
+        xmin, xmax, ymin, ymax = self.info
+        nameimg = num.rot90(img[xmin:xmax, ymin:ymax])
+
+        if self.score is not None and len(self.score):
+            xmin, xmax, ymin, ymax = self.score
+            score = num.rot90(img[xmin:xmax, ymin:ymax])
+            nameimg = num.hstack([nameimg[30:75, :], score])
+
+        return nameimg.copy()
+
+    def apply_fit(self, offset, fit, means):
+        """restore stored fit data (see read_exam) without fitting"""
+        self._set_offset(*offset)
+        self.fit, self.means = fit, means
+        if self.refzone:
+            self._set_transform(self._get_affine_fit(offset, fit))
+
+    def is_flagged(self, choices):
+        """sheet needs review: unread answer or unmatched reference box"""
+        return bool(num.any(choices == -1) or num.any(num.array(self.fit) == -9999))
 
     def write_validation(self, img, imfile):
-        """ write output validation image"""
+        """overlay reference fit and bubble means (modifies img), write
+        output validation image"""
+        if self.refzone:
+            img = self._overlay_ref_fit(img, self.offset, self.fit)
+
+        img = self._overlay_bubble_means(img, self.means)
         self._save_validation(img, imfile)
-        self._save_info_image(img, imfile)
 
     def _calc_coords(self):
-        """calculate (m, n, 4) sized matrix of answer bubble
-        hmin,hmax,wmin,wmax coordinates"""
-        i = num.outer(num.arange(self.size[0]), num.ones(self.size[1]))
-        i0 = self.pos[0] + (i * self.space[0])
-        i1 = self.pos[0] + (i * self.space[0]) + self.bub[0]
-
-        j = num.outer(num.ones(self.size[0]), num.arange(self.size[1]))
-        j0 = self.pos[1] + (j * self.space[1])
-        j1 = self.pos[1] + (j * self.space[1]) + self.bub[1]
-
-        self.coords = num.dstack((i0, i1, j0, j1)).astype('i')
+        """calculate the (bubbles, 4) table of answer bubble
+        hmin,hmax,wmin,wmax coordinates of all blocks with the question
+        and choice index of each bubble"""
+        coords, question, choice = [], [], []
+        first = 0  # first question number of the block
+        for b in self.blocks:
+            i = num.outer(num.arange(b['size'][0]), num.ones(b['size'][1]))
+            i0 = b['pos'][0] + (i * b['space'][0])
+            i1 = b['pos'][0] + (i * b['space'][0]) + b['bub'][0]
+
+            j = num.outer(num.ones(b['size'][0]), num.arange(b['size'][1]))
+            j0 = b['pos'][1] + (j * b['space'][1])
+            j1 = b['pos'][1] + (j * b['space'][1]) + b['bub'][1]
+
+            coords.append(num.dstack((i0, i1, j0, j1)).reshape(-1, 4))
+            question.append(first + i.ravel().astype('i'))
+            choice.append(j.ravel().astype('i'))
+            first += b['size'][0]
+
+        self.coords = num.vstack(coords).astype('i')
+        self.question = num.hstack(question)
+        self.choice = num.hstack(choice)
+        self.grid_shape = (first, max(b['size'][1] for b in self.blocks))
+
+    def grid_means(self, values):
+        """arrange per bubble values (..., bubbles) into a (...,
+        questions, choices) matrix. Padded choices of narrower blocks are
+        blank (255)"""
+        values = num.asarray(values)
+        means = num.empty(values.shape[:-1] + self.grid_shape)
+        means.fill(255.0)
+        means[..., self.question, self.choice] = values
+        return means
 
     def _set_offset(self, r=0, c=0):
         """update positional parameters with offset, recalculate
         extracted rectangles and coordinates matrix"""
         self.offset = num.array(self.offset) + num.array([r, c])
         self.pos = [self.pos[0] + r, self.pos[1] + c]
+        for b in self.blocks:
+            b['pos'] = [b['pos'][0] + r, b['pos'][1] + c]
 
         if self.info:
             self.info = num.array(self.info) + num.array([r, r, c, c])
@@ -183,6 +359,20 @@ class Form:
 
         self._calc_coords()
 
+    def _set_transform(self, transform):
+        """move the bubble, info and score rectangle centers by an affine
+        transform of offset coordinates (None for no change)"""
+        self.transform = transform
+        if transform is None:
+            return
+
+        self.coords = _move_rects(self.coords, transform)
+        if self.info is not None and len(self.info):
+            self.info = _move_rects(self.info, transform)
+
+        if self.score is not None and len(self.score):
+            self.score = _move_rects(self.score, transform)
+
     def _load_image(self, imfile):
         """open input image, correct dpi, return greyscale array"""
         im = Image.open(str(imfile))
@@ -217,29 +407,44 @@ class Form:
         """Get the best translation offset by fitting black box
         reference zones"""
         bw_img = 255 * (img >= self.contrast)
-        fit = [center_on_box(bw_img, self.radius, self.min_ref, *ref) for ref in self.refzone]
+        fit = num.array([center_on_box(bw_img, self.radius, self.min_ref, *ref) for ref in self.refzone])
         meanfit = num.mean(num.ma.masked_array(fit, fit == -9999), axis=0).astype('i')
         if meanfit[0] is num.ma.masked:
             raise StandardError('At least one reference box match required')
 
         return meanfit, fit
 
+    def _get_affine_fit(self, offset, fit):
+        """least squares affine transform (3, 2) from the offset to the
+        fitted reference box centers. None if fewer than 3 boxes matched,
+        the boxes are collinear or the scale/shear exceeds max_skew."""
+        fit = num.asarray(fit)
+        matched = num.all(fit != -9999, axis=1)
+        if not self.max_skew or matched.sum() < 3:
+            return None
+
+        ref = num.asarray(self.refzone, 'd')[matched]
+        centers = num.column_stack(((ref[:, 0] + ref[:, 1]) / 2, (ref[:, 2] + ref[:, 3]) / 2))
+        source = num.column_stack((centers + offset, num.ones(len(centers))))
+        transform, _res, rank, _sv = num.linalg.lstsq(source, centers + fit[matched], rcond=-1)
+        if rank < 3 or num.abs(transform[:2] - num.eye(2)).max() > self.max_skew:
+            return None
+
+        return transform
+
     def _get_bubble_means(self, img):
-        """get the mean pixel value in each answer bubble region"""
+        """get the mean pixel value in each answer bubble region (all
+        blocks in one pass over a summed area table)"""
         bw_img = 255 * (img >= self.contrast)
-        means = num.zeros(self.coords.shape[:2])
-        for (i, j) in product(*map(range, self.size)):
-            i0, i1, j0, j1 = self.coords[i, j, :]
-            means[i, j] = num.mean(bw_img[i0:i1, j0:j1])
-
-        return means
+        return self.grid_means(rect_means(summed_area(bw_img), self.coords))
 
     def _choose_answers(self, means):
-        """choose darkest answer choice. assign poor signal choices -1"""
-        choice = num.argmin(means, axis=1)
+        """choose darkest answer choice of (..., questions, choices)
+        means. assign poor signal choices -1"""
+        choice = num.argmin(means, axis=-1)
         if self.signal:
-            sorted_rows = num.sort(means, axis=1)
-            signal = sorted_rows[:, 1] / sorted_rows[:, 0]
+            sorted_rows = num.sort(means, axis=-1)
+            signal = sorted_rows[..., 1] / sorted_rows[..., 0]
             choice[signal <= self.signal] = -1
 
         return choice
@@ -274,29 +479,20 @@ class Form:
 
     def _overlay_bubble_means(self, img, means):
         """overlay the bubble region mean values onto the validation image"""
-        for (i, j) in product(*map(range, self.size)):
-            i0, i1, j0, j1 = self.coords[i, j, :]
-            img[i0:i1, j0:j1] = means[i, j]
+        for (i0, i1, j0, j1), q, c in zip(self.coords, self.question, self.choice):
+            img[i0:i1, j0:j1] = means[q, c]
 
         return img
 
     def _save_validation(self, img, imfile):
-        """extract the forms info box region and stack the score box"""
+        """write the validation image"""
         val_file = join(dirname(imfile), 'OMR', 'validation', basename(imfile))
         Image.fromarray(img).save(val_file)
 
-    def _save_info_image(self, img, imfile):
-        if len(self.info):
-            xmin, xmax, ymin, ymax = self.info
-            nameimg = num.rot90(img[xmin:xmax, ymin:ymax])
-
-            if len(self.score):
-                xmin, xmax, ymin, ymax = self.score
-                score = num.rot90(img[xmin:xmax, ymin:ymax])
-                nameimg = num.hstack([nameimg[30:75, :], score])
-
-            name_file = join(dirname(imfile), 'OMR', 'names', basename(imfile)[:-3] + 'png')
-            Image.fromarray(nameimg).save(name_file)
+    def _save_info_image(self, nameimg, imfile):
+        """write the name image png"""
+        name_file = join(dirname(imfile), 'OMR', 'names', basename(imfile)[:-3] + 'png')
+        Image.fromarray(nameimg).save(name_file)
 
 
 def center_on_box(img, radius, min_ref, xmin, xmax, ymin, ymax, na_val=-9999):
@@ -319,4 +515,59 @@ def center_on_box(img, radius, min_ref, xmin, xmax, ymin, ymax, na_val=-9999):
     if num.nanmin(fit) <= min_ref:
         return num.array(coords[num.nanargmin(fit)])
     else:
-        return num.array([na_val, na_val]) 
+        return num.array([na_val, na_val])
+
+
+def _move_rects(rects, transform):
+    """move [..., 4] hmin,hmax,wmin,wmax rectangle centers by an affine
+    transform (3, 2), keeping the rectangle sizes"""
+    rects = num.asarray(rects)
+    centers = num.dot(rects, [[0.5, 0], [0.5, 0], [0, 0.5], [0, 0.5]])
+    moved = num.dot(centers, transform[:2]) + transform[2]
+    shift = num.rint(moved - centers).astype(rects.dtype)
+    return rects + shift[..., [0, 0, 1, 1]]
+
+
+def summed_area(img):
+    """summed area table with a leading row and column of zeros. The sum
+    of img[i0:i1, j0:j1] is sat[i1, j1] - sat[i0, j1] - sat[i1, j0] + sat[i0, j0]"""
+    sat = num.zeros((img.shape[0] + 1, img.shape[1] + 1))
+    sat[1:, 1:] = num.cumsum(num.cumsum(img, axis=0), axis=1)
+    return sat
+
+
+def shifted_means(sat, r, i0, i1, j0, j1):
+    """mean of a rectangle shifted by every offset within +/- r pixels
+    from a summed area table. Shifts outside the image are 255."""
+    di, dj = num.meshgrid(num.arange(-r, r + 1), num.arange(-r, r + 1), indexing='ij')
+    a0, a1, b0, b1 = i0 + di, i1 + di, j0 + dj, j1 + dj
+    inside = (a0 >= 0) & (b0 >= 0) & (a1 < sat.shape[0]) & (b1 < sat.shape[1]) & (i1 > i0) & (j1 > j0)
+    a0, a1 = num.clip(a0, 0, sat.shape[0] - 1), num.clip(a1, 0, sat.shape[0] - 1)
+    b0, b1 = num.clip(b0, 0, sat.shape[1] - 1), num.clip(b1, 0, sat.shape[1] - 1)
+    sums = sat[a1, b1] - sat[a0, b1] - sat[a1, b0] + sat[a0, b0]
+    return num.where(inside, sums / max((i1 - i0) * (j1 - j0), 1), 255.0)
+
+
+def rect_means(sat, rects):
+    """mean value of each [..., 4] hmin,hmax,wmin,wmax rectangle from a
+    summed area table (rectangles are clipped to the image)"""
+    rects = num.asarray(rects)
+    i0, i1 = [num.clip(rects[..., k], 0, sat.shape[0] - 1) for k in (0, 1)]
+    j0, j1 = [num.clip(rects[..., k], 0, sat.shape[1] - 1) for k in (2, 3)]
+    sums = sat[i1, j1] - sat[i0, j1] - sat[i1, j0] + sat[i0, j0]
+    return sums / num.maximum((i1 - i0) * (j1 - j0), 1)
+
+
+def rect_crops(img, rects, shape):
+    """crops (rects, h, w) of img at each (rects, 4) hmin,hmax,wmin,wmax
+    rectangle (clipped to the image) padded to shape (h, w) in one
+    gather, masks of the pixels inside each rectangle and the rectangle
+    areas"""
+    rects = num.asarray(rects)
+    i0, i1 = [num.clip(rects[:, k], 0, img.shape[0]) for k in (0, 1)]
+    j0, j1 = [num.clip(rects[:, k], 0, img.shape[1]) for k in (2, 3)]
+    rows = i0[:, None] + num.arange(shape[0])
+    cols = j0[:, None] + num.arange(shape[1])
+    crops = img[num.minimum(rows, img.shape[0] - 1)[:, :, None], num.minimum(cols, img.shape[1] - 1)[:, None, :]]
+    masks = (rows < i1[:, None])[:, :, None] & (cols < j1[:, None])[:, None, :]
+    return crops, masks, (i1 - i0) * (j1 - j0)
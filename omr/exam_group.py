@@ -1,14 +1,16 @@
 #Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
 """process a group of test images contained in a directory"""
 
+from collections import OrderedDict
 from functools import partial
 from glob import glob
-from itertools import repeat, product
-from os import mkdir
-from os.path import basename, join
+from itertools import chain, repeat, product
+from os import listdir, mkdir
+from os.path import abspath, basename, exists, join
 from re import findall
 from shutil import rmtree
-from numpy import array, histogram, hstack, savetxt, sum, vstack, zeros
+from numpy import array, histogram, hstack, ones, savetxt, sum, vstack, zeros
+from PIL import Image
 
 try:
     import openpyxl
@@ -16,27 +18,63 @@ try:
 except ImportError:
     openpyxl = None
 
-from omr import FORMS, process_exam
+from omr import FORMS
+from omr.detect import process_detected
+from omr.exam import read_exam, read_exams
+from omr.prefilter import prefilter_images, write_prefilter_report
+from omr.render import render_validation, save_fitdata
 
 _NUMSORT = lambda x: float(".".join(findall('[0-9]+', basename(x))[:2]))
 """extract the first two numeric blocks of a path as a float"""
 
 
-def main(frontdir, form, backdir=None, pool=None):
-    """Main command line application. """
-
-    fimg, fchoice, fout = process_exam_group(frontdir, form, 'front', pool)
+def main(frontdir, form, backdir=None, pool=None, validation='none', render=None, names=False,
+         cache=None, prefilter=False, cohort=None, chunk=1):
+    """Main command line application. Form 'auto' detects the form and
+    side of each image and writes results grouped by form (front and
+    back directories are then processed independently). If render is
+    a list, only render validation images from stored fit data for the
+    named images (all flagged images if empty). names writes name image
+    png files. cache is an optional decoded image cache. prefilter skips
+    blank and duplicate images (front and back paired by position, a
+    skipped back image reads -1). cohort is an optional Cohort the
+    choices are merged into (not with form 'auto'). chunk is the number
+    of sheets read per worker task."""
+    if render is not None:
+        for testdir in filter(None, [frontdir, backdir]):
+            render_validation(join(testdir, 'OMR'), render)
+        return
+
+    if form == 'auto':
+        if cohort is not None:
+            raise StandardError('cohort statistics need a single form (not auto)')
+
+        for testdir in filter(None, [frontdir, backdir]):
+            groups, outdir = process_mixed_group(testdir, pool, validation, names, cache)
+            write_mixed_group(groups, outdir)
+        return
+
+    fimg, fchoice, fout, fnames = process_exam_group(frontdir, form, 'front', pool, validation, names, cache,
+                                                     prefilter, chunk)
 
     if backdir:
-        bimg, bchoice, bout = process_exam_group(backdir, form, 'back', pool)
+        bimg, bchoice, bout, bnames = process_exam_group(backdir, form, 'back', pool, validation, names, cache,
+                                                         prefilter, chunk)
+        if prefilter:
+            bchoice = _pair_back(find_images(frontdir), fimg, find_images(backdir), bimg, bchoice)
+
         fchoice = hstack((fchoice, bchoice))
 
-    write_exam_group(fimg, fchoice, fout)
+    write_exam_group(fimg, fchoice, fout, fnames)
+    if cohort is not None:
+        cohort.merge(fchoice, abspath(fout))
+        cohort.save()
 
 
-def process_exam_group(testdir, formstr, side, pool=None):
-    """Process all test images in a directory returning image path list and 
-    choice matrix. 
+def process_exam_group(testdir, formstr, side, pool=None, validation='none', names=False, cache=None,
+                       prefilter=False, chunk=1, forms=None):
+    """Process all test images in a directory returning image path list, 
+    choice matrix, output directory and name image arrays. 
     
     
     testdir  
@@ -51,37 +89,149 @@ def process_exam_group(testdir, formstr, side, pool=None):
     pool     
         Parallel processing pool 
 
+    validation
+        Validation images written while processing (none, flagged, all)
+
+    names
+        Write name image png files
+
+    cache
+        Decoded image cache (ImageCache or None)
+
+    prefilter
+        Skip blank and duplicate images (listed in OMR/prefilter.csv)
+
+    chunk
+        Sheets read per worker task. Above 1, the bubble means and
+        answers of each chunk are computed in single vectorized calls
+        (see read_exams)
+
+    forms
+        form specification dictionary (default FORMS)
+
     
     Procedure
     
     - Create output directory in input test image dir.
     - find .jpg images, sort in place by first 2 numeric blocks
+    - Optionally skip blank and duplicate images.
     - Run each test (possibly in parallel). 
+    - Store fit data for deferred validation rendering.
         
     
     """
     # define output directories 
-    wd = join(testdir, 'OMR')
-    rmtree(wd, True)
-    [mkdir(join(wd, p)) for p in ['', 'validation', 'names']]
+    wd = make_outdir(testdir)
 
     # get image paths
-    images = sorted(glob(join(testdir, '*.jpg')), key=_NUMSORT)
-    if not images:
-        raise StandardError('at least one image is required')
+    images = find_images(testdir)
+
+    # skip blank and duplicate images
+    if prefilter:
+        blank, duplicate = prefilter_images(images, (forms or FORMS)[formstr][side], pool)
+        write_prefilter_report(wd, images, blank, duplicate)
+        images = [im for im, b, d in zip(images, blank, duplicate) if not b and d < 0]
+        if not images:
+            raise StandardError('at least one image is required')
 
     # process each image
-    func = partial(process_exam, formcfg=FORMS[formstr][side])
+    formcfg = dict((forms or FORMS)[formstr][side], cache=cache)
+    if chunk > 1:
+        func = partial(read_exams, formcfg=formcfg, validation=validation, names=names)
+        chunks = [images[i:i + chunk] for i in range(0, len(images), chunk)]
+        records = list(chain.from_iterable(pool.map(func, chunks) if pool else map(func, chunks)))
+    else:
+        func = partial(read_exam, formcfg=formcfg, validation=validation, names=names)
+        records = pool.map(func, images) if pool else map(func, images)
+
+    save_fitdata(wd, formstr, side, images, records)
+
+    # return image list, choices, output direcory and name images
+    return images, vstack([r['choices'] for r in records]), wd, [r['name'] for r in records]
+
+
+def _pair_back(fronts, kept_fronts, backs, kept_backs, bchoice):
+    """back choices of the kept front images, fronts and backs paired by
+    position. Skipped back images read -1."""
+    choices = -ones((len(backs), bchoice.shape[1]), 'i')
+    choices[[backs.index(b) for b in kept_backs]] = bchoice
+    return choices[[fronts.index(f) for f in kept_fronts]]
+
+
+def process_mixed_group(testdir, pool=None, validation='none', names=False, cache=None):
+    """Process a directory of mixed form images. Detect the form and side
+    of each image, returning an ordered dictionary of (images, choice
+    matrix, name images) keyed by (form, side) and the output directory.
+    Undetected images are keyed by (None, None) with no choices."""
+    wd = make_outdir(testdir)
+    images = find_images(testdir)
+    func = partial(process_detected, validation=validation, names=names, cache=cache)
     if pool:
-        choices = pool.map(func, images)
+        results = pool.map(func, images)
     else:
-        choices = map(func, images)
+        results = map(func, images)
+
+    groups = OrderedDict()
+    for imfile, (formstr, side, record) in zip(images, results):
+        group = groups.setdefault((formstr, side), ([], []))
+        group[0].append(imfile)
+        group[1].append(record)
 
-    # return image list, choices, and output direcory
-    return images, vstack(choices), wd
+    for (formstr, side), (im, records) in groups.items():
+        if formstr is not None:
+            save_fitdata(wd, formstr, side, im, records)
 
+    return OrderedDict((k, (im, vstack([r['choices'] for r in rec]), [r['name'] for r in rec])
+                        if k[0] else (im, None, None)) for k, (im, rec) in groups.items()), wd
+
+
+def write_mixed_group(groups, outdir):
+    """Write each detected form group to an outdir/<form>_<side>
+    subdirectory and list undetected images in outdir/undetected.csv"""
+    for (formstr, side), (images, choices, names) in groups.items():
+        if formstr is None:
+            savetxt(join(outdir, 'undetected.csv'), images, fmt='%s')
+            continue
+
+        groupdir = join(outdir, '{}_{}'.format(formstr, side))
+        mkdir(groupdir)
+        write_exam_group(images, choices, groupdir, names)
+
+
+def make_outdir(testdir, clean=True):
+    """create the OMR output directory tree inside a test image directory.
+    Remove any previous output first unless clean is False."""
+    wd = join(testdir, 'OMR')
+    if clean:
+        rmtree(wd, True)
 
-def write_exam_group(images, choices, outdir):
+    [mkdir(join(wd, p)) for p in ['', 'validation', 'names'] if not exists(join(wd, p))]
+    return wd
+
+
+def find_images(testdir):
+    """return .jpg image paths (any case) in a directory sorted by first 2
+    numeric blocks"""
+    images = sorted((join(testdir, f) for f in listdir(testdir) if f.lower().endswith('.jpg')), key=_NUMSORT)
+    if not images:
+        raise StandardError('at least one image is required')
+
+    return images
+
+
+def score_exam_group(choices, key=None):
+    """Score a choice matrix against a key (default first test). Return
+    scoring matrix, score by test, and correct count by question
+    (excluding the first test)."""
+    key = array(choices[0] if key is None else key)  # key is the first test (copy)
+    key[key == -1] = -2  # -2 key allows -1 tests to score 0
+    scoring = choices == key  # score all
+    score_by_test = sum(scoring, 1)  # score by test
+    score_by_question = sum(scoring[1:, :], 0)  # exclude key
+    return scoring, score_by_test, score_by_question
+
+
+def write_exam_group(images, choices, outdir, names=None):
     """Write exam group output
     
     
@@ -94,28 +244,27 @@ def write_exam_group(images, choices, outdir):
     outdir   
         output path
 
+    names
+        list of name image arrays or paths (default all images in outdir/names)
+
     - Score tests using first image as the key.  
     - Count choice frequency by question. 
     - Write csv and xlsx data files 
     
     """
     #score tests
-    key = choices[0]  # key is the first test
-    key[key == -1] = -2  # -2 key allows -1 tests to score 0
-    scoring = choices == key  # score all
-    score_by_test = sum(scoring, 1)  # score by test
-    score_by_question = sum(scoring[1:, :], 0)  # exclude key
+    scoring, score_by_test, score_by_question = score_exam_group(choices)
 
-    # count choice frequency
-    counts = zeros((choices.shape[1], 9))
+    # count choice frequency (at least A-E, wider grid blocks add columns)
+    nchoice = max(5, choices.max() + 1)
+    counts = zeros((choices.shape[1], 4 + nchoice))
     counts[:, 0] = range(1, 1 + choices.shape[1])  # question number
     counts[:, 1] = choices[0, :]  # correct choice
     counts[:, 2] = score_by_question  # correct count by question (ex key)
     for i in range(counts.shape[0]):  # choice frequencies by question
-        counts[i, 3:9], _x = histogram(choices[1:, i], range(-1, 6))
+        counts[i, 3:], _x = histogram(choices[1:, i], range(-1, nchoice + 1))
 
-    counts_header = ['Question', 'Key', 'CorrectCount',
-                     'None(-1)', 'A(0)', 'B(1)', 'C(2)', 'D(3)', 'E(4)']
+    counts_header = ['Question', 'Key', 'CorrectCount'] + choice_header(nchoice)
 
     # csv output
     savetxt(join(outdir, 'imagefiles.csv'), images, fmt='%s')
@@ -126,16 +275,21 @@ def write_exam_group(images, choices, outdir):
 
     # xls output
     if openpyxl is not None:
-        name_files = sorted(glob(join(outdir, 'names', '*')), key=_NUMSORT)
+        name_files = names or sorted(glob(join(outdir, 'names', '*')), key=_NUMSORT)
 
         wb = openpyxl.Workbook()
-        wb = write_xls_images(wb, name_files, score_by_test, 'summary')
+        wb = write_xls_images(wb, name_files, score_by_test, 'summary', files=images)
         wb = write_xls_array(wb, counts, 'question info', counts_header, width=6)
         wb = write_xls_array(wb, scoring.astype('i'), 'scoring', width=3)
         wb = write_xls_array(wb, choices, 'choices', width=3)
         wb.save(join(outdir, 'results.xlsx'))
 
 
+def choice_header(nchoice):
+    """choice count column names: None(-1), A(0), B(1), ..."""
+    return ['None(-1)'] + ['{}({})'.format(chr(65 + c) if c < 26 else c, c) for c in range(nchoice)]
+
+
 def write_xls_array(workbook, inarray, title=None, header=None, row=0, col=0, width=None, height=None):
     """write input array to a new sheet in input xlsx workbook
     
@@ -192,9 +346,11 @@ def write_xls_array(workbook, inarray, title=None, header=None, row=0, col=0, wi
 
 
 def write_xls_images(workbook, name_images, scores, title=None, header=['Info', 'Score', 'File'],
-                     height=23, width=[47, 5, 20], scale=[0.65, 0.65]):
+                     height=23, width=[47, 5, 20], scale=[0.65, 0.65], files=None):
     """write xlsx file containing a table of extracted info box images,
-    score, and file name for each test"""
+    score, and file name for each test. Info images are arrays (embedded
+    from memory) or paths, a None image (unreadable sheet) marks its row.
+    File names default to the info image paths."""
     ws = workbook.get_active_sheet()
     if title:
         ws.title = title
@@ -202,7 +358,7 @@ def write_xls_images(workbook, name_images, scores, title=None, header=['Info',
     if header:
         [setattr(ws.cell(row=0, column=j), 'value', h) for j, h in enumerate(header)]
 
-    for row, (score, name_file) in enumerate(zip(scores, name_images)):
+    for row, (score, name_file) in enumerate(zip(scores, name_images if files is None else files)):
         ws.cell(row=row + 1, column=1).value = score
         ws.cell(row=row + 1, column=2).value = basename(name_file)
 
@@ -214,16 +370,22 @@ def write_xls_images(workbook, name_images, scores, title=None, header=['Info',
         for k in ws.row_dimensions.keys():
             setattr(ws.row_dimensions[k], 'height', height)
 
-    if name_images:
+    if not name_images:
+        setattr(ws.cell(row=1, column=0), 'value', 'ERROR: Info images not found')
+
+    size = None
+    for r, im in enumerate(name_images or []):  # rows without an image (unreadable sheet) are marked
+        if im is None:
+            setattr(ws.cell(row=r + 1, column=0), 'value', 'ERROR: Info image not found')
+            continue
+
         try:
-            size = openpyxl.drawing.Image(str(name_images[0])).image.size * array(scale)
-            for r, im in enumerate(name_images):
-                img = openpyxl.drawing.Image(str(im), size=size)
-                img.anchor(ws.cell(row=r + 1, column=0))
-                ws.add_image(img)
+            im = Image.fromarray(im) if hasattr(im, 'shape') else Image.open(str(im))
+            size = array(im.size) * array(scale) if size is None else size
+            img = openpyxl.drawing.Image(im, size=size)
+            img.anchor(ws.cell(row=r + 1, column=0))
+            ws.add_image(img)
         except: # TODO specify exception
-            setattr(ws.cell(row=1, column=0), 'value', 'ERROR: Info images could not be loaded')
-    else:
-        setattr(ws.cell(row=1, column=0), 'value', 'ERROR: Info images not found')
+            setattr(ws.cell(row=r + 1, column=0), 'value', 'ERROR: Info image could not be loaded')
 
     return workbook
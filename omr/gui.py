@@ -59,6 +59,7 @@ class Gui(Tkinter.Frame):
         self.text.grid(row=2, columnspan=3, pady=5)
 
         Tkinter.Button(self, text='Quit', command=self.quit, width=8).grid(row=3, column=0, sticky=Tkinter.W)
+        Tkinter.Button(self, text='Render Flagged', command=self.render_flagged, width=14).grid(row=3, column=1)
         Tkinter.Button(self, text='Run', command=self.run_app, width=8).grid(row=3, column=2, sticky=Tkinter.E)
 
     def run_app(self):
@@ -72,6 +73,17 @@ class Gui(Tkinter.Frame):
 
         self.call(args)
 
+    def render_flagged(self):
+        """render validation images for flagged tests of the last run"""
+        if [self.msg(v) for k, v in self.prechecks.items() if not eval(k)]:
+            return None
+
+        args = [self.front.get()]
+        if self.back.get():
+            args.append('--backdir={}'.format(self.back.get()))
+
+        self.call(args + ['--render'])
+
     def call(self, args, see=Tkinter.END):
         """run the command with input args. Use echo and output to print
         the command and response"""
@@ -16,15 +16,73 @@ def parse_args():
     """parse command line arguments."""
     parser = argparse.ArgumentParser(description="Extract answer choices from scanned jpg bubble forms.")
 
-    parser.add_argument('frontdir', help="Image directory.")
+    parser.add_argument('frontdir', nargs='?', help="Image directory (root directory or manifest with --batch).")
 
     parser.add_argument('-b', '--backdir', default=None,
                         help='Optional back side image directory')
 
     parser.add_argument('-f', '--form', default='882E',
-                        choices=omr.FORMS.keys(), help='Form string')
+                        choices=omr.FORMS.keys() + ['auto'],
+                        help='Form string (auto detects the form of each image)')
 
-    return parser.parse_args()
+    parser.add_argument('-v', '--validation', default='none', choices=omr.VALIDATION,
+                        help='Validation images written while processing')
+
+    parser.add_argument('-n', '--names', action='store_true',
+                        help='Write name image png files')
+
+    parser.add_argument('-p', '--prefilter', action='store_true',
+                        help='Skip blank and duplicate images (listed in OMR/prefilter.csv)')
+
+    parser.add_argument('--chunk', default=1, type=int, metavar='K',
+                        help='Sheets read per worker task, vectorized over the chunk (default 1)')
+
+    parser.add_argument('-r', '--render', nargs='*', default=None, metavar='IMAGE',
+                        help='Only render validation images for the named images '
+                             '(all flagged images if none) from stored fit data')
+
+    parser.add_argument('-c', '--cache', default=None, metavar='DIR',
+                        help='Decoded image cache directory for fast re-analysis')
+
+    parser.add_argument('--cache-size', default=1024, type=int, metavar='MB',
+                        help='Decoded image cache size limit (default 1024 MB)')
+
+    parser.add_argument('--cohort', default=None, metavar='DIR',
+                        help='Merge results into running cohort statistics stored in DIR')
+
+    parser.add_argument('--batch', action='store_true',
+                        help='Process every image directory below frontdir, or the (front, back, form) '
+                             'jobs listed in a frontdir manifest csv, through one pool')
+
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Suggest form thresholds from a sample of images (no processing)')
+
+    parser.add_argument('-k', '--key', default=None, metavar='CSV',
+                        help='Calibration key: expected front choices csv (key image or all images)')
+
+    parser.add_argument('--sample', default=20, type=int,
+                        help='Number of images sampled for calibration (default 20)')
+
+    parser.add_argument('--serve', default=None, metavar='[HOST:]PORT',
+                        help='Run as a service accepting jobs over local HTTP')
+
+    parser.add_argument('--serve-root', default=None, metavar='DIR',
+                        help='Only accept service jobs below DIR (required unless serving on loopback)')
+
+    args = parser.parse_args()
+    if not (args.frontdir or args.serve):
+        parser.error('frontdir is required')
+
+    if args.cohort and args.form == 'auto':
+        parser.error('--cohort needs a single form (not auto)')
+
+    if args.batch and args.form == 'auto':
+        parser.error('--batch needs a single form (not auto)')
+
+    if args.calibrate and args.form == 'auto':
+        parser.error('--calibrate needs a single form (not auto)')
+
+    return args
 
 
 if __name__ == '__main__':
@@ -33,7 +91,29 @@ if __name__ == '__main__':
         args = parse_args()
         args.pool = multiprocessing.Pool()
 
-        omr.main(**vars(args))
+        if args.cache:
+            args.cache = omr.ImageCache(args.cache, args.cache_size * 2 ** 20)
+        del args.cache_size
+
+        if args.cohort:
+            args.cohort = omr.Cohort(args.cohort)
+
+        serve, calibrate, key, sample, batch = args.serve, args.calibrate, args.key, args.sample, args.batch
+        root = args.serve_root
+        del args.serve, args.calibrate, args.key, args.sample, args.batch, args.serve_root
+
+        if serve:
+            host, _sep, port = serve.rpartition(':')
+            omr.serve((host or '127.0.0.1', int(port)), args.pool, args.cache, root)
+        elif calibrate:
+            print omr.calibrate_group(args.frontdir, args.form, 'front', key, sample, args.pool, args.cache)
+            if args.backdir:
+                print omr.calibrate_group(args.backdir, args.form, 'back', None, sample, args.pool, args.cache)
+        elif batch:
+            omr.main_batch(args.frontdir, args.form, args.pool, args.validation, args.names, args.cache,
+                           args.cohort)
+        else:
+            omr.main(**vars(args))
 
         args.pool.close()
         args.pool.join()
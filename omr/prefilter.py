@@ -0,0 +1,150 @@
+#Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
+"""blank and duplicate page pre-filter
+
+Runs on small DCT-scaled thumbnails before the full pipeline so blank
+pages (duplex backs) and re-fed duplicate sheets are skipped instead of
+being fitted and read (blank pages usually fail the reference fit).
+
+- blank: fraction of trimmed thumbnail pixels darker than the form
+  contrast (ink coverage) below min_ink.
+- duplicate: sheets of one form share the printed layout, so each
+  thumbnail is hashed on its residual against the median thumbnail of
+  the group (marks and handwriting only). A sheet whose hash is within
+  max_distance (hamming distance / union of set bits) of an earlier
+  kept sheet is a candidate. Students with the same answers hash alike,
+  so a candidate is only a duplicate if its info and score regions,
+  read at form resolution, have near identical ink (at most
+  max_name_distance of the ink pixels differ at the best shift within
+  the form search radius). The regions include the printed box, so
+  different names still share most ink (about 0.14 apart on the test
+  sheets against 0.02 for a recompressed re-feed). Forms without info
+  and score regions compare the whole page. Needs at least 3 non blank
+  sheets.
+
+"""
+import numpy as num
+
+from functools import partial
+from os.path import join
+from PIL import Image
+
+from omr.detect import load_thumbnail, trim_thumbnail
+from omr.exam import Form
+
+RESIDUAL = 8
+"""minimum mean block darkening (grey levels) of a set hash bit"""
+
+
+def prefilter_images(images, formcfg, pool=None, min_ink=0.01, max_distance=0.7, max_name_distance=0.06,
+                     scale=8, block=4):
+    """Return blank flags and the index of the earlier sheet each image
+    duplicates (-1 if unique)"""
+    func = partial(thumbnail_signature, formcfg=formcfg, scale=scale, block=block)
+    signatures = pool.map(func, images) if pool else map(func, images)
+    ink = num.array([s[0] for s in signatures])
+    thumbs = num.array([s[1] for s in signatures])
+
+    blank = ink < min_ink
+    duplicate = -num.ones(len(images), 'i')
+    live = num.flatnonzero(~blank)
+    if len(live) >= 3:
+        hashes = residual_hash(thumbs[live], num.median(thumbs[live], axis=0), block)
+        dist = hash_distance(hashes)
+        regions = {}
+        for a in range(1, len(live)):
+            for b in num.flatnonzero((dist[a, :a] <= max_distance) & (duplicate[live[:a]] < 0)):
+                for i in live[a], live[b]:
+                    if i not in regions:
+                        regions[i] = region_signature(images[i], formcfg)
+
+                if region_distance(regions[live[a]], regions[live[b]]) <= max_name_distance:
+                    duplicate[live[a]] = live[b]
+                    break
+
+    return blank, duplicate
+
+
+def thumbnail_signature(imfile, formcfg, scale=8, block=4):
+    """ink coverage and trimmed thumbnail resized to the scaled form size
+    (multiple of block)"""
+    thumb, _ratio = load_thumbnail(imfile, scale)
+    thumb = trim_thumbnail(thumb, formcfg['trim_std'])
+    shape = num.array(formcfg['expected_size']) // scale // block * block
+    if not thumb.size:
+        return 0.0, num.full(shape, 255.0, 'f')
+
+    ink = num.mean(thumb < formcfg['contrast'])
+    resized = Image.fromarray(thumb).resize(tuple(shape[::-1]), Image.BILINEAR)
+    return ink, num.array(resized, 'f')
+
+
+def residual_hash(thumbs, template, block=4):
+    """(n, bits) hash of blocks darker than the template"""
+    residual = num.clip(template - thumbs, 0, None)
+    n, h, w = residual.shape
+    blocks = residual.reshape(n, h // block, block, w // block, block).mean(axis=(2, 4))
+    return blocks.reshape(n, -1) > RESIDUAL
+
+
+def hash_distance(hashes):
+    """pairwise hamming distance over union of set bits (1 if both empty)"""
+    h = hashes.astype('f')
+    inter = num.dot(h, h.T)
+    counts = h.sum(axis=1)
+    union = counts[:, None] + counts[None, :] - inter
+    with num.errstate(divide='ignore', invalid='ignore'):
+        dist = (union - inter) / union
+
+    dist[union == 0] = 1.0
+    return dist
+
+
+def region_signature(imfile, formcfg):
+    """ink (darker than contrast) of the info and score regions (or the
+    whole page) of the trimmed sheet at about form resolution, padded by
+    the search radius"""
+    form = Form(**formcfg)
+    dpi = Image.open(str(imfile)).info.get('dpi', form.expected_dpi)
+    thumb, ratio = load_thumbnail(imfile, max(1, int(min(num.true_divide(dpi, form.expected_dpi)))))
+    factor = ratio / num.array(form.expected_dpi, 'f')  # thumb px per form px
+    thumb = trim_thumbnail(thumb, form.trim_std)
+
+    rects = [r for r in [form.info, form.score] if r is not None and len(r)]
+    rects = rects or [[0, form.expected_size[0], 0, form.expected_size[1]]]
+    m = int(num.ceil(form.radius * num.max(factor)))
+    padded = num.pad(thumb, m, 'constant', constant_values=255)
+    regions = []
+    for rect in rects:
+        i0, i1, j0, j1 = (num.array(rect) * num.repeat(factor, 2)).astype('i')
+        regions.append((padded[i0:i1 + 2 * m, j0:j1 + 2 * m] < form.contrast, m))
+
+    return regions
+
+
+def region_distance(regions_a, regions_b):
+    """fraction of differing ink pixels over the union of ink pixels at
+    the best shift of each region (1 if no ink)"""
+    diff = union = 0
+    for (a, m), (b, _m) in zip(regions_a, regions_b):
+        a = a[m:a.shape[0] - m, m:a.shape[1] - m]
+        h, w = a.shape
+        best = (num.inf, 0)
+        for di in range(b.shape[0] - h + 1):
+            for dj in range(b.shape[1] - w + 1):
+                window = b[di:di + h, dj:dj + w]
+                best = min(best, (num.count_nonzero(a ^ window), num.count_nonzero(a | window)))
+
+        diff, union = diff + best[0], union + best[1]
+
+    return float(diff) / union if union else 1.0
+
+
+def write_prefilter_report(outdir, images, blank, duplicate):
+    """write OMR/prefilter.csv listing skipped images and the reason"""
+    with open(join(outdir, 'prefilter.csv'), 'w') as f:
+        f.write('image,reason,duplicate_of\n')
+        for imfile, b, d in zip(images, blank, duplicate):
+            if b:
+                f.write('{},blank,\n'.format(imfile))
+            elif d >= 0:
+                f.write('{},duplicate,{}\n'.format(imfile, images[d]))
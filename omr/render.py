@@ -0,0 +1,86 @@
+#Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
+"""deferred validation image rendering from stored fit data
+
+Processing stores only the compact fit data of each sheet in
+OMR/fitdata_<form>_<side>.npz. Validation images are regenerated on
+demand for chosen sheets or for every flagged sheet (unread answer or
+unmatched reference box).
+
+fitdata arrays::
+
+    images     (n,) image paths
+    choices    (n, questions) answer choices
+    offsets    (n, 2) fitted reference offset
+    fits       (n, refzones, 2) per refzone fitted offsets
+    means      (n, questions, choices) answer bubble means
+    form       form string
+    side       form side
+
+"""
+import numpy as num
+
+from glob import glob
+from multiprocessing import get_logger
+from os.path import basename, join
+
+from omr.exam import Form
+from omr.forms import FORMS
+
+LOG = get_logger()
+
+
+def save_fitdata(outdir, formstr, side, images, records):
+    """write fit data records returned by read_exam for a group of images"""
+    nref = len(next((r['fit'] for r in records if r['fit'] is not None), []))
+    fits = [r['fit'] if r['fit'] is not None else num.zeros((nref, 2)) for r in records]
+    num.savez(join(outdir, 'fitdata_{}_{}.npz'.format(formstr, side)),
+              images=num.array(images), form=formstr, side=side,
+              choices=num.array([r['choices'] for r in records]),
+              offsets=num.array([r['offset'] for r in records], 'i'),
+              fits=num.array(fits, 'i').reshape(len(records), nref, 2),
+              means=num.array([r['means'] for r in records]))
+
+
+def load_fitdata(outdir):
+    """return list of fit data dictionaries stored in an output directory"""
+    data = []
+    for path in sorted(glob(join(outdir, 'fitdata_*.npz'))):
+        with num.load(path) as f:
+            data.append(dict((k, f[k]) for k in f.files))
+
+    return data
+
+
+def flagged(fitdata):
+    """boolean index of sheets needing review"""
+    return (num.any(fitdata['choices'] == -1, axis=1) |
+            num.any(fitdata['fits'].reshape(len(fitdata['images']), -1) == -9999, axis=1))
+
+
+def render_validation(outdir, images=None):
+    """render validation images from stored fit data. Render the named
+    images (path or file name) or every flagged sheet if none are given.
+    Return list of rendered image paths."""
+    names = set(map(basename, images or []))
+    rendered = []
+    for fitdata in load_fitdata(outdir):
+        if names:
+            select = num.array([basename(im) in names for im in fitdata['images']], 'b')
+        else:
+            select = flagged(fitdata)
+
+        formcfg = FORMS[str(fitdata['form'])][str(fitdata['side'])]
+        for i in num.flatnonzero(select):
+            imfile = str(fitdata['images'][i])
+            form = Form(**formcfg)
+            try:
+                img = form.import_image(imfile)
+            except StandardError, e:  # unreadable sheet (see batch)
+                LOG.warning('{} not rendered: {}'.format(imfile, e))
+                continue
+
+            form.apply_fit(fitdata['offsets'][i], fitdata['fits'][i], fitdata['means'][i])
+            form.write_validation(img, imfile)
+            rendered.append(imfile)
+
+    return rendered
@@ -0,0 +1,174 @@
+#Copyright (C) 2013 Greg Miller <gmill002@gmail.com>
+"""long running omr service with a warm worker pool
+
+The service keeps one processing pool and the resolved form
+specifications resident and accepts jobs over a local HTTP api. Scanning
+stations can submit a directory or single sheets and receive choices and
+scores as JSON without paying for interpreter start up and pool spin up.
+
+requests::
+
+    GET  /forms      {"882E": ["back", "front"], ...}
+
+    POST /process    {"form": "882E", "side": "front", "dir": "/scans/class1"}
+                     {"form": "882E", "side": "front", "images": ["/scans/a.jpg"],
+                      "key": [0, 3, ...]}
+
+responses::
+
+    {"images": [...], "choices": [[...], ...], "scores": [...]}
+    {"error": "message"}                         (status 400)
+
+A directory job behaves like a command line run (output directory is
+recreated and the csv and xlsx results written, first image is the
+key). An image job keeps any existing
+output and scores against "key" if given, otherwise the first image.
+
+Jobs write (and directory jobs delete) OMR output directories next to
+the images. With a root directory, only paths below root are accepted.
+Addresses other than loopback require a root.
+
+"""
+import json
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from functools import partial
+from multiprocessing import get_logger
+from os.path import dirname, join, realpath
+from numpy import vstack
+
+from omr.exam import Form, process_exam
+from omr.exam_group import make_outdir, process_exam_group, score_exam_group, write_exam_group
+from omr.forms import FORMS
+
+LOG = get_logger()
+
+
+class OmrService(HTTPServer):
+    """HTTP server holding a warm processing pool and form specifications
+
+
+    address
+        (host, port) to listen on. Port 0 picks a free port.
+
+    pool
+        Parallel processing pool (kept open between jobs)
+
+    forms
+        form specification dictionary (default FORMS)
+
+    cache
+        decoded image cache (ImageCache or None)
+
+    root
+        only accept job paths below this directory (required unless the
+        address is loopback)
+
+    """
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 8750), pool=None, forms=None, cache=None, root=None):
+        if root is None and not _loopback(address[0]):
+            raise ValueError('serving on {} requires a job root directory'.format(address[0]))
+
+        HTTPServer.__init__(self, address, OmrRequestHandler)
+        self.pool = pool
+        self.cache = cache
+        self.root = realpath(root) if root else None
+        self.forms = {}
+        for formstr, sides in (forms or FORMS).items():
+            for side, cfg in sides.items():
+                Form(**cfg)  # fail at start up on a broken specification
+                self.forms[(formstr, side)] = cfg
+
+    def process(self, job):
+        """run a job dictionary returning a JSON serializable result"""
+        formstr, side = job.get('form', '882E'), job.get('side', 'front')
+        if (formstr, side) not in self.forms:
+            raise ValueError('unknown form {} {}'.format(formstr, side))
+
+        key = job.get('key')
+        if job.get('dir'):
+            self._check_path(job['dir'])
+            forms = {formstr: {side: self.forms[(formstr, side)]}}
+            images, choices, outdir, names = process_exam_group(job['dir'], formstr, side, self.pool,
+                                                                cache=self.cache, forms=forms)
+            write_exam_group(images, choices, outdir, names)
+        elif job.get('images'):
+            images = list(job['images'])
+            map(self._check_path, images)
+            [make_outdir(d, clean=False) for d in set(map(dirname, images))]
+            formcfg = dict(self.forms[(formstr, side)], cache=self.cache)
+            func = partial(process_exam, formcfg=formcfg, validation='none', names=False)
+            choices = vstack((self.pool.map if self.pool else map)(func, images))
+        else:
+            raise ValueError('job requires "dir" or "images"')
+
+        _scoring, score_by_test, _by_question = score_exam_group(choices, key)
+        return {'images': images,
+                'choices': choices.tolist(),
+                'scores': score_by_test.tolist()}
+
+    def _check_path(self, path):
+        """reject job paths outside the root directory"""
+        if self.root and not join(realpath(path), '').startswith(join(self.root, '')):
+            raise ValueError('path outside the service root: {}'.format(path))
+
+    def form_names(self):
+        """return available forms and sides"""
+        names = {}
+        for formstr, side in self.forms:
+            names.setdefault(formstr, []).append(side)
+
+        return dict((k, sorted(v)) for k, v in names.items())
+
+
+class OmrRequestHandler(BaseHTTPRequestHandler):
+    """translate HTTP requests into service calls"""
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/forms':
+            self._reply(200, self.server.form_names())
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/process':
+            return self._reply(404, {'error': 'not found'})
+
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+            job = json.loads(self.rfile.read(length))
+            result = self.server.process(job)
+        except Exception, e:  # report any job failure to the client
+            LOG.warning('job failed: {}'.format(e))
+            return self._reply(400, {'error': str(e)})
+
+        self._reply(200, result)
+
+    def _reply(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        LOG.info(fmt % args)
+
+
+def serve(address, pool=None, cache=None, root=None):
+    """run the service until interrupted"""
+    server = OmrService(address, pool, cache=cache, root=root)
+    print 'serving on http://{}:{}'.format(*server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _loopback(host):
+    """host name or address is the local machine only"""
+    return host == 'localhost' or host == '::1' or host.startswith('127.')
@@ -11,18 +11,44 @@ test classes::
     test_single_exam       test processing single exam
     test_exam_group        test exam group
     test_write_exam_group  test exam group output
+    test_service           test jobs submitted to the local service
+    test_mixed_group       test form detection and grouped output
+    test_render            test deferred validation rendering
+    test_image_cache       test decoded image cache
+    test_calibrate         test threshold calibration
+    test_batch             test multi directory batch processing
+    test_batch_failures    test batch upper case extensions and unreadable sheets
+    test_grid_blocks       test multi block answer grids
+    test_prefilter         test blank and duplicate page pre-filter
+    test_affine_fit        test affine reference fit of skewed scans
+    test_cohort            test incremental cohort statistics
+    test_chunked_exams     test chunked (vectorized) sheet reading
 
 """
 from pkg_resources import resource_filename
 import os
 import glob
+import json
+import numpy
+import urllib2
 from random import randrange
-from shutil import copytree
+from shutil import copyfile, copytree
+from threading import Thread
+from zipfile import ZipFile
+from PIL import Image, ImageOps
 from unittest import TestCase
 
-from omr.exam_group import process_exam_group, write_exam_group
-from omr.exam import process_exam
+from omr.batch import find_jobs, main_batch, process_batch
+from omr.cache import ImageCache
+from omr.cohort import Cohort
+from omr.calibrate import calibrate, calibrate_group, score_signals
+from omr.detect import detect_form
+from omr.exam_group import main, process_exam_group, process_mixed_group, write_exam_group, write_mixed_group
+from omr.exam import Form, process_exam, read_exam, read_exams, rect_crops, rect_means, summed_area
 from omr.forms import FORMS
+from omr.prefilter import prefilter_images, region_distance, region_signature
+from omr.render import flagged, load_fitdata, render_validation
+from omr.service import OmrService
 
 PACKAGE_DIR = os.path.dirname(resource_filename('omr', ''))
 TEST_DATA = os.path.join(PACKAGE_DIR, 'test_omr', 'test_data')  # testing data folder
@@ -84,7 +110,7 @@ class test_exam_group(OmrTestCase):
         """setup exam group test fixture"""
         super(test_exam_group, self).setUpClass()
         
-        self.images, self.choices, self.outdir = process_exam_group(self.path, self.form, self.side)
+        self.images, self.choices, self.outdir, self.names = process_exam_group(self.path, self.form, self.side)
         
     def test_outpath_exists(self):
         """exam group: output directories created"""
@@ -92,15 +118,18 @@ class test_exam_group(OmrTestCase):
         self.assertTrue(os.path.exists(os.path.join(self.outdir, 'validation')))
         self.assertTrue(os.path.exists(os.path.join(self.outdir, 'names')))
                 
-    def test_validation_images_exist(self):
-        """exam group: all validation images written"""
+    def test_validation_images_deferred(self):
+        """exam group: no validation images written, fit data stored"""
         val_images = glob.glob(os.path.join(self.outdir, 'validation', '*'))
-        self.assertEqual(len(self.images), len(val_images))
+        self.assertEqual(len(val_images), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.outdir, 'fitdata_882E_front.npz')))
     
-    def test_name_images_exist(self):
-        """exam group: all name images written"""
+    def test_name_images_in_memory(self):
+        """exam group: all name images returned, no png written"""
         name_images = glob.glob(os.path.join(self.outdir, 'names', '*'))
-        self.assertEqual(len(self.images), len(name_images)) 
+        self.assertEqual(len(name_images), 0)
+        self.assertEqual(len(self.images), len(self.names))
+        self.assertEqual(self.names[0].dtype, 'uint8')
 
 
 class test_write_exam_group(test_exam_group):
@@ -110,8 +139,546 @@ class test_write_exam_group(test_exam_group):
         """setup write exam group test fixture"""
         super(test_write_exam_group, self).setUpClass()
         
-        write_exam_group(self.images, self.choices, self.outdir)
+        write_exam_group(self.images, self.choices, self.outdir, self.names)
     
     def test_output_files(self):
         """exam group: output files exist"""
         self.assertTrue(os.path.exists(os.path.join(self.outdir, 'results.xlsx')))
+
+    def test_summary_images(self):
+        """exam group: name images embedded in summary"""
+        with ZipFile(os.path.join(self.outdir, 'results.xlsx')) as f:
+            media = [n for n in f.namelist() if 'media' in n]
+        self.assertEqual(len(self.images), len(media))
+
+
+class test_service(OmrTestCase):
+    """service tests"""
+    @classmethod  
+    def setUpClass(self):
+        """start service on a free localhost port"""
+        super(test_service, self).setUpClass()
+        self.server = OmrService(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        Thread(target=self.server.serve_forever).start()
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, job):
+        try:
+            return json.loads(urllib2.urlopen(self.url + '/process', json.dumps(job)).read())
+        except urllib2.HTTPError, e:
+            return json.loads(e.read())
+
+    def test_forms(self):
+        """service: form list"""
+        forms = json.loads(urllib2.urlopen(self.url + '/forms').read())
+        self.assertEqual(forms[self.form], ['back', 'front'])
+
+    def test_dir_job(self):
+        """service: directory job returns choices and scores"""
+        result = self.post({'form': self.form, 'side': self.side, 'dir': self.path})
+        self.assertEqual(len(result['images']), 3)
+        self.assertEqual(len(result['choices']), 3)
+        self.assertEqual(result['scores'][0], sum(k != -1 for k in result['choices'][0]))
+        for f in ['results.xlsx', 'choices.csv']:
+            self.assertTrue(os.path.exists(os.path.join(self.outdir, f)))
+
+    def test_image_job(self):
+        """service: single image job scored against key"""
+        key = self.post({'dir': self.path})['choices'][0]
+        result = self.post({'images': [self.imfile], 'key': key})
+        self.assertEqual(len(result['choices']), 1)
+        self.assertEqual(result['scores'][0], sum(k != -1 for k in key))
+
+    def test_bad_job(self):
+        """service: bad job reports error"""
+        self.assertTrue('error' in self.post({'form': 'nonexistent'}))
+
+    def test_custom_forms(self):
+        """service: directory job uses the service form specification"""
+        server = OmrService(('127.0.0.1', 0), forms={'custom': {'front': self.formcfg}}, root=self.path)
+        try:
+            result = server.process({'form': 'custom', 'side': 'front', 'dir': self.path})
+            self.assertEqual(len(result['choices']), 3)
+            self.assertRaises(ValueError, server.process, {'form': 'custom', 'dir': os.path.dirname(self.path)})
+            self.assertRaises(ValueError, server.process, {'form': 'custom', 'images': [TEST_DATA + '/x.jpg']})
+        finally:
+            server.server_close()
+
+    def test_public_address(self):
+        """service: non loopback address requires a root"""
+        self.assertRaises(ValueError, OmrService, ('0.0.0.0', 0))
+
+
+class test_mixed_group(OmrTestCase):
+    """form detection tests"""
+    @classmethod  
+    def setUpClass(self):
+        """setup mixed group test fixture"""
+        super(test_mixed_group, self).setUpClass()
+        
+        self.groups, self.outdir = process_mixed_group(self.path)
+        write_mixed_group(self.groups, self.outdir)
+
+    def test_detect_form(self):
+        """mixed group: single image form detected"""
+        formstr, side = detect_form(self.imfile)
+        self.assertEqual((formstr, side), (self.form, 'front'))
+
+    def test_groups(self):
+        """mixed group: all images detected and grouped"""
+        self.assertEqual(self.groups.keys(), [(self.form, 'front')])
+        (formstr, side), (images, choices, names) = self.groups.items()[0]
+        self.assertEqual(len(images), choices.shape[0])
+        self.assertEqual(len(images), len(names))
+
+    def test_output_files(self):
+        """mixed group: group output files exist"""
+        for formstr, side in self.groups:
+            groupdir = os.path.join(self.outdir, '{}_{}'.format(formstr, side))
+            self.assertTrue(os.path.exists(os.path.join(groupdir, 'results.xlsx')))
+
+
+class test_render(OmrTestCase):
+    """deferred validation rendering tests"""
+    @classmethod  
+    def setUpClass(self):
+        """setup rendering test fixture"""
+        super(test_render, self).setUpClass()
+        
+        self.images, self.choices, self.outdir, self.names = process_exam_group(self.path, self.form, self.side)
+
+    def test_fitdata(self):
+        """render: fit data stored for every image"""
+        fitdata = load_fitdata(self.outdir)[0]
+        self.assertEqual(list(fitdata['images']), self.images)
+        self.assertEqual(fitdata['means'].shape, (len(self.images), 50, 5))
+        self.assertTrue((fitdata['choices'] == self.choices).all())
+
+    def test_render_named(self):
+        """render: named image validation rendered"""
+        rendered = render_validation(self.outdir, [os.path.basename(self.imfile)])
+        self.assertEqual(rendered, [self.imfile])
+        val_file = os.path.join(self.outdir, 'validation', os.path.basename(self.imfile))
+        self.assertTrue(os.path.exists(val_file))
+
+    def test_render_flagged(self):
+        """render: flagged image validation rendered"""
+        flagged = [im for im, ch in zip(self.images, self.choices) if (ch == -1).any()]
+        self.assertEqual(sorted(render_validation(self.outdir)), sorted(flagged))
+
+
+class test_image_cache(OmrTestCase):
+    """decoded image cache tests"""
+    @classmethod  
+    def setUpClass(self):
+        """process exam group twice through the cache"""
+        super(test_image_cache, self).setUpClass()
+        
+        self.cache = ImageCache(os.path.join(self.path, 'cache'))
+        self.first = process_exam_group(self.path, self.form, self.side, cache=self.cache)[1]
+        self.second = process_exam_group(self.path, self.form, self.side, cache=self.cache)[1]
+
+    def test_pages_cached(self):
+        """image cache: one page per image"""
+        self.assertEqual(len(glob.glob(os.path.join(self.cache.path, '*.npy'))), 3)
+
+    def test_cached_choices(self):
+        """image cache: cached pages give the same choices"""
+        self.assertTrue((self.first == self.second).all())
+
+    def test_evict(self):
+        """image cache: least recently used pages evicted"""
+        page = (self.first + 1).astype('uint8')
+        cache = ImageCache(os.path.join(self.path, 'small'), max_bytes=1)
+        cache.put('a', page)
+        cache.put('b', page)
+        self.assertTrue(cache.get('a') is None)
+        self.assertTrue((cache.get('b') == page).all())
+
+
+class test_calibrate(OmrTestCase):
+    """threshold calibration tests"""
+    @classmethod  
+    def setUpClass(self):
+        """calibrate against the choices read with the current form"""
+        super(test_calibrate, self).setUpClass()
+        
+        self.images, self.choices, self.outdir, _names = process_exam_group(self.path, self.form, self.side)
+        self.rows, self.suggestion = calibrate(self.images, self.form, self.side, key=self.choices)
+
+    def test_current_setting(self):
+        """calibrate: current setting reproduces processed choices"""
+        cfg = self.formcfg
+        row = self.rows[(self.rows[:, 1] == cfg['contrast']) & (self.rows[:, 2] == cfg['min_ref']) &
+                        (self.rows[:, 3] == cfg['signal'])]
+        self.assertEqual(len(row), 1)
+        self.assertEqual(row[0, 6], 0)  # failed
+        self.assertEqual(row[0, 7], 1)  # agreement
+        self.assertAlmostEqual(row[0, 4], (self.choices == -1).mean())  # ambiguous
+
+    def test_suggestion(self):
+        """calibrate: suggestion agrees with the key"""
+        self.assertTrue(set(self.formcfg) <= set(self.suggestion))
+        best = self.rows[(self.rows[:, 1] == self.suggestion['contrast']) &
+                         (self.rows[:, 2] == self.suggestion['min_ref']) &
+                         (self.rows[:, 3] == self.suggestion['signal'])]
+        self.assertEqual(best[0, 7], 1)
+
+    def test_output_files(self):
+        """calibrate: calibration files written"""
+        text = calibrate_group(self.path, self.form, self.side, sample=2)
+        self.assertTrue(self.form in text)
+        self.assertTrue(os.path.exists(os.path.join(self.outdir, 'calibration.csv')))
+        self.assertTrue(os.path.exists(os.path.join(self.outdir, 'calibration.yaml')))
+
+    def test_signal_rate(self):
+        """calibrate: ambiguous rate over all readable sheets"""
+        means = numpy.array([[[10, 100, 100], [10, 10.5, 100]]] + [[[10, 100, 100]] * 2] * 2, 'd')
+        ambiguous, _agreement = score_signals(means, [0, 0, 0], [1.1])
+        self.assertAlmostEqual(ambiguous[0], 1 / 6.0)
+        ambiguous, _agreement = score_signals(means, [False, True, True], [1.1])
+        self.assertAlmostEqual(ambiguous[0], 0.5)
+
+    def test_blank_page(self):
+        """calibrate: blank page in the sample counted as failed"""
+        os.mkdir(os.path.join(self.path, 'blank'))
+        blank = os.path.join(self.path, 'blank', 'Image (0).jpg')
+        Image.new('L', (664, 1664), 255).save(blank, dpi=self.formcfg['expected_dpi'])
+        grid = {'trim_std': [4], 'contrast': [178], 'min_ref': [127], 'signal': [1.1]}
+        rows, _suggestion = calibrate([self.imfile, blank], self.form, self.side, grid=grid)
+        self.assertEqual(rows[0, 6], 0.5)  # failed
+
+    def test_key_width(self):
+        """calibrate: key width checked, front columns of a front and back key"""
+        key = numpy.hstack((self.choices, -numpy.ones_like(self.choices)))
+        self.assertRaises(StandardError, calibrate, self.images, self.form, self.side, key)
+        numpy.savetxt(os.path.join(self.outdir, 'checked.csv'), key, fmt='%i', delimiter=',')
+        grid = {'trim_std': [self.formcfg['trim_std']], 'contrast': [self.formcfg['contrast']],
+                'min_ref': [self.formcfg['min_ref']], 'signal': [self.formcfg['signal']]}
+        calibrate_group(self.path, self.form, self.side, os.path.join(self.outdir, 'checked.csv'), grid=grid)
+        rows = numpy.loadtxt(os.path.join(self.outdir, 'calibration.csv'), delimiter=',', ndmin=2)
+        self.assertEqual(rows[0, 7], 1)  # agreement
+
+    def test_auto_form(self):
+        """calibrate: auto form rejected"""
+        self.assertRaises(StandardError, calibrate, [self.imfile], 'auto', self.side)
+
+
+class test_batch(OmrTestCase):
+    """multi directory batch tests"""
+    @classmethod  
+    def setUpClass(self):
+        """split test images into two class directories and a back side"""
+        super(test_batch, self).setUpClass()
+        
+        self.root = os.path.join(self.path, 'batch')
+        self.dirs = [os.path.join(self.root, d) for d in ['class1', 'class2', 'class2_back']]
+        for d, images in zip(self.dirs, [[0, 1], [2], [2]]):
+            os.makedirs(d)
+            for i in images:
+                copyfile(os.path.join(self.path, 'Image ({}).jpg'.format(i)), os.path.join(d, '{}.jpg'.format(i)))
+
+        self.manifest = os.path.join(self.path, 'manifest.csv')
+        with open(self.manifest, 'w') as f:
+            f.write('{},,{}\n{},{},{}\n'.format(self.dirs[0], self.form, self.dirs[1], self.dirs[2], self.form))
+
+    def test_find_jobs(self):
+        """batch: image directories found below root"""
+        self.assertEqual(find_jobs(self.root, self.form), [(d, None, self.form) for d in self.dirs])
+
+    def test_manifest(self):
+        """batch: manifest jobs written, longest first"""
+        outdirs = main_batch(self.manifest, self.form)
+        self.assertEqual(outdirs, [os.path.join(d, 'OMR') for d in self.dirs[:2]])
+        for outdir, shape in zip(outdirs, [(2, 50), (1, 100)]):
+            self.assertTrue(os.path.exists(os.path.join(outdir, 'results.xlsx')))
+            choices = numpy.loadtxt(os.path.join(outdir, 'choices.csv'), delimiter=',', ndmin=2)
+            self.assertEqual(choices.shape, shape)
+
+
+class test_batch_failures(OmrTestCase):
+    """batch tests with upper case extensions and an unreadable sheet"""
+    @classmethod  
+    def setUpClass(self):
+        """one group of .JPG images, one group with a corrupt second sheet"""
+        super(test_batch_failures, self).setUpClass()
+        
+        self.root = os.path.join(self.path, 'failures')
+        self.dirs = [os.path.join(self.root, d) for d in ['broken', 'upper']]
+        map(os.makedirs, self.dirs)
+        for i in [0, 1]:
+            copyfile(os.path.join(self.path, 'Image ({}).jpg'.format(i)), os.path.join(self.dirs[1], '{}.JPG'.format(i)))
+        copyfile(self.imfile, os.path.join(self.dirs[0], '0.jpg'))
+        with open(os.path.join(self.dirs[0], '1.jpg'), 'w') as f:
+            f.write('not a jpeg')
+
+        self.outdirs = main_batch(self.root, self.form)
+
+    def test_groups_written(self):
+        """batch failures: both groups written"""
+        self.assertEqual(sorted(self.outdirs), [os.path.join(d, 'OMR') for d in self.dirs])
+        for outdir in self.outdirs:
+            self.assertTrue(os.path.exists(os.path.join(outdir, 'results.xlsx')))
+
+    def test_name_images(self):
+        """batch failures: name images of the readable sheets embedded"""
+        for d, readable in zip(self.dirs, [1, 2]):
+            with ZipFile(os.path.join(d, 'OMR', 'results.xlsx')) as f:
+                media = [n for n in f.namelist() if 'media' in n]
+            self.assertEqual(len(media), readable)
+
+    def test_auto_form(self):
+        """batch failures: auto form rejected before any output"""
+        self.assertRaises(StandardError, process_batch, [(self.dirs[1], None, 'auto')])
+
+    def test_failed_sheet(self):
+        """batch failures: unreadable sheet reads -1 and is flagged"""
+        choices = numpy.loadtxt(os.path.join(self.dirs[0], 'OMR', 'choices.csv'), delimiter=',')
+        self.assertTrue((choices[1] == -1).all())
+        self.assertTrue((choices[0] != -1).any())
+        fitdata = load_fitdata(os.path.join(self.dirs[0], 'OMR'))[0]
+        self.assertTrue(flagged(fitdata)[1])
+        rendered = render_validation(os.path.join(self.dirs[0], 'OMR'))
+        self.assertFalse(os.path.join(self.dirs[0], '1.jpg') in rendered)
+
+
+class test_grid_blocks(mock_exam_group):
+    """multi block answer grid tests"""
+    @classmethod  
+    def setUpClass(self):
+        """split the answer grid into two blocks and add a 3 choice block"""
+        super(test_grid_blocks, self).setUpClass()
+        
+        grid = dict((k, self.formcfg[k]) for k in ['size', 'pos', 'space', 'bub'])
+        top = dict(grid, size=[25, 5])
+        bottom = dict(grid, size=[25, 5], pos=[grid['pos'][0] + 25 * grid['space'][0], grid['pos'][1]])
+        extra = dict(grid, size=[2, 3])
+        self.blockcfg = dict(self.formcfg, blocks=[top, bottom, extra])
+        self.choices = process_exam(self.imfile, self.formcfg, 'none', False)
+        self.block_choices = process_exam(self.imfile, self.blockcfg, 'none', False)
+
+    def test_coordinate_table(self):
+        """grid blocks: one coordinate table for all blocks"""
+        form = Form(**self.blockcfg)
+        self.assertEqual(form.coords.shape, (256, 4))
+        self.assertEqual(form.grid_shape, (52, 5))
+        self.assertTrue((form.coords[:250] == Form(**self.formcfg).coords).all())
+
+    def test_block_choices(self):
+        """grid blocks: split grid reads the same choices"""
+        self.assertEqual(len(self.block_choices), 52)
+        self.assertTrue((self.block_choices[:50] == self.choices).all())
+        self.assertTrue((self.block_choices[50:] < 3).all())
+
+    def test_wide_block_counts(self):
+        """grid blocks: question info counts choices past E"""
+        choices = numpy.array([[0, 9], [4, 5], [0, 6], [-1, 9]])
+        write_exam_group(['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg'], choices, self.outdir)
+        with open(os.path.join(self.outdir, 'questioninfo.csv')) as f:
+            header = f.readline().strip('# \n').split(',')
+        counts = numpy.loadtxt(os.path.join(self.outdir, 'questioninfo.csv'), delimiter=',')
+        self.assertEqual(header[-1], 'J(9)')
+        self.assertEqual(counts[1, 3:].tolist(), [0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 1])
+
+
+class test_prefilter(OmrTestCase):
+    """blank and duplicate page pre-filter tests"""
+    @classmethod  
+    def setUpClass(self):
+        """add a blank page and a shifted, recompressed re-feed of the first image"""
+        super(test_prefilter, self).setUpClass()
+        
+        img = Image.open(self.imfile).convert('L')
+        refeed = Image.new('L', img.size, 255)
+        refeed.paste(img.crop((0, 0, img.size[0] - 6, img.size[1] - 4)), (6, 4))
+        refeed.save(os.path.join(self.path, 'Image (8).jpg'), quality=70, dpi=img.info['dpi'])
+        Image.new('L', img.size, 255).save(os.path.join(self.path, 'Image (9).jpg'), dpi=img.info['dpi'])
+        
+        # same answers as the first image, name and score of the second
+        page = Form(**self.formcfg).import_image(self.imfile).copy()
+        other = Form(**self.formcfg).import_image(os.path.join(self.path, 'Image (1).jpg'))
+        for i0, i1, j0, j1 in [self.formcfg['info'], self.formcfg['score']]:
+            page[i0:i1, j0:j1] = other[i0:i1, j0:j1]
+        Image.fromarray(page).save(os.path.join(self.path, 'Image (7).jpg'), dpi=self.formcfg['expected_dpi'])
+        
+        self.images = sorted(glob.glob(os.path.join(self.path, '*.jpg')))
+        self.blank, self.duplicate = prefilter_images(self.images, self.formcfg)
+        self.results = process_exam_group(self.path, self.form, self.side, prefilter=True)
+
+    def test_flags(self):
+        """prefilter: blank page and re-feed found"""
+        names = [os.path.basename(im) for im in self.images]
+        self.assertEqual([names[i] for i in numpy.flatnonzero(self.blank)], ['Image (9).jpg'])
+        self.assertEqual(self.duplicate[names.index('Image (8).jpg')], names.index('Image (0).jpg'))
+        self.assertEqual(sum(self.duplicate >= 0), 1)
+
+    def test_same_answers(self):
+        """prefilter: same answers with a different name not a duplicate"""
+        names = [os.path.basename(im) for im in self.images]
+        self.assertEqual(self.duplicate[names.index('Image (7).jpg')], -1)
+        key = region_signature(self.imfile, self.formcfg)
+        self.assertTrue(region_distance(region_signature(self.images[names.index('Image (7).jpg')], self.formcfg),
+                                        key) > 0.06)
+        self.assertTrue(region_distance(region_signature(self.images[names.index('Image (8).jpg')], self.formcfg),
+                                        key) <= 0.06)
+
+    def test_skipped(self):
+        """prefilter: skipped images not processed and reported"""
+        images, choices = self.results[:2]
+        self.assertEqual(len(images), 4)
+        self.assertEqual(choices.shape, (4, 50))
+        with open(os.path.join(self.outdir, 'prefilter.csv')) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+
+class test_affine_fit(mock_exam_group):
+    """affine reference fit tests"""
+    @classmethod  
+    def setUpClass(self):
+        """rotate and stretch the trimmed first image"""
+        super(test_affine_fit, self).setUpClass()
+        
+        page = Image.fromarray(Form(**self.formcfg).import_image(self.imfile))
+        page = ImageOps.invert(ImageOps.invert(page).rotate(1.2, Image.BICUBIC))  # white corners
+        page = page.resize((page.size[0], int(page.size[1] * 1.012)), Image.BICUBIC)
+        self.skewed = os.path.join(self.path, 'skewed.jpg')
+        page.save(self.skewed, dpi=self.formcfg['expected_dpi'], quality=90)
+        
+        self.choices = process_exam(self.imfile, self.formcfg, 'none', False)
+        self.form = Form(**self.formcfg)
+        self.skewed_choices = self.form.from_file(self.skewed, 'none', False)
+
+    def test_skewed_choices(self):
+        """affine fit: skewed scan reads the same choices"""
+        self.assertTrue(self.form.transform is not None)
+        self.assertTrue((self.skewed_choices == self.choices).all())
+
+    def test_translation_only(self):
+        """affine fit: mean offset alone misreads the skewed scan"""
+        choices = process_exam(self.skewed, dict(self.formcfg, max_skew=0), 'none', False)
+        self.assertTrue((choices != self.choices).any())
+
+    def test_apply_fit(self):
+        """affine fit: stored fit data restores the moved coordinates"""
+        form = Form(**self.formcfg)
+        form.apply_fit(self.form.offset, self.form.fit, self.form.means)
+        self.assertTrue((form.coords == self.form.coords).all())
+        self.assertTrue((form.info == self.form.info).all())
+
+    def test_calibrate(self):
+        """affine fit: calibration reads the skewed scan as processing"""
+        grid = dict((k, [self.formcfg[k]]) for k in ['trim_std', 'contrast', 'min_ref', 'signal'])
+        rows, _suggestion = calibrate([self.skewed], '882E', 'front', self.skewed_choices, grid=grid)
+        self.assertEqual(rows[0, 7], 1)  # agreement
+
+
+class test_cohort(OmrTestCase):
+    """incremental cohort statistics tests"""
+    @classmethod  
+    def setUpClass(self):
+        """merge two random groups with a shared key and a processed batch"""
+        super(test_cohort, self).setUpClass()
+        
+        rng = numpy.random.RandomState(0)
+        key = rng.randint(0, 5, 20)
+        self.groups = [numpy.vstack([key, numpy.where(rng.rand(n, 20) < 0.6, key, rng.randint(-1, 5, (n, 20)))])
+                       for n in [30, 12]]
+        self.cohortdir = os.path.join(self.path, 'cohort')
+        self.cohort = Cohort(self.cohortdir)
+        self.merged = [self.cohort.merge(g, name) for g, name in zip(self.groups, ['a', 'b'])]
+        self.merged.append(self.cohort.merge(self.groups[0], 'a'))
+        self.cohort.save()
+        
+        self.batchdir = os.path.join(self.path, 'batchcohort')
+        self.batch_outdirs = main_batch(self.path, self.form, cohort=Cohort(self.batchdir))
+
+    def test_merge(self):
+        """cohort: totals equal the concatenated groups, repeat merge skipped"""
+        tests = numpy.vstack([g[1:] for g in self.groups])
+        scoring = tests == self.groups[0][0]
+        self.assertEqual(self.merged, [True, True, False])
+        self.assertEqual(self.cohort.size, 42)
+        self.assertTrue((self.cohort.correct == scoring.sum(0)).all())
+        self.assertTrue((self.cohort.scores == numpy.bincount(scoring.sum(1), minlength=21)).all())
+        self.assertTrue((self.cohort.counts[:, 0] == (tests == -1).sum(0)).all())
+
+    def test_item_stats(self):
+        """cohort: point biserial discrimination matches the correlation"""
+        tests = numpy.vstack([g[1:] for g in self.groups])
+        scoring = (tests == self.groups[0][0]).astype('d')
+        total = scoring.sum(1)
+        expected = [numpy.corrcoef(scoring[:, q], total)[0, 1] for q in range(20)]
+        self.assertTrue(numpy.allclose(self.cohort.item_stats()[:, 4], expected))
+
+    def test_persisted(self):
+        """cohort: state reloaded between runs, reports written"""
+        cohort = Cohort(self.cohortdir)
+        self.assertEqual(cohort.groups, ['a', 'b'])
+        self.assertTrue((cohort.counts == self.cohort.counts).all())
+        self.assertFalse(cohort.merge(self.groups[1], 'b'))
+        for f in ['questioninfo.csv', 'scores.csv']:
+            self.assertTrue(os.path.exists(os.path.join(self.cohortdir, f)))
+
+    def test_save_without_replace(self):
+        """cohort: repeated save where rename cannot replace (windows)"""
+        rename = os.rename
+        def no_replace(src, dst):
+            if os.path.exists(dst):
+                raise OSError('file exists')
+            rename(src, dst)
+
+        os.rename = no_replace
+        try:
+            self.cohort.save()
+            self.cohort.save()
+        finally:
+            os.rename = rename
+        self.assertEqual(Cohort(self.cohortdir).groups, ['a', 'b'])
+
+    def test_auto_form(self):
+        """cohort: auto form detection rejected"""
+        self.assertRaises(StandardError, main, self.path, 'auto', cohort=self.cohort)
+
+    def test_batch(self):
+        """cohort: batch groups merged as they complete"""
+        cohort = Cohort(self.batchdir)
+        self.assertEqual(cohort.groups, [os.path.abspath(d) for d in self.batch_outdirs])
+        self.assertEqual(cohort.size, 2)
+
+
+class test_chunked_exams(OmrTestCase):
+    """chunked sheet reading tests"""
+    @classmethod  
+    def setUpClass(self):
+        """read the test images one by one and in one chunk"""
+        super(test_chunked_exams, self).setUpClass()
+        
+        self.images = sorted(glob.glob(os.path.join(self.path, '*.jpg')))
+        self.records = [read_exam(im, self.formcfg) for im in self.images]
+        self.chunk_records = read_exams(self.images, self.formcfg)
+
+    def test_records(self):
+        """chunked exams: same choices, fits and means as one by one"""
+        self.assertEqual(len(self.chunk_records), len(self.records))
+        for a, b in zip(self.records, self.chunk_records):
+            for k in ['choices', 'offset', 'fit', 'means', 'name']:
+                self.assertTrue((numpy.asarray(a[k]) == numpy.asarray(b[k])).all())
+
+    def test_rect_crops(self):
+        """chunked exams: crop means equal summed area means, clipped at edges"""
+        img = numpy.random.RandomState(0).randint(0, 256, (40, 30))
+        rects = numpy.array([[0, 5, 0, 7], [10, 16, 20, 30], [35, 45, 25, 35], [-3, 4, -2, 3]])
+        crops, masks, areas = rect_crops(img, rects, (10, 10))
+        means = (crops * masks).sum(axis=(1, 2)) / numpy.maximum(areas, 1).astype('d')
+        self.assertTrue(numpy.allclose(means, rect_means(summed_area(img), rects)))
+
+    def test_exam_group(self):
+        """chunked exams: partial last chunk, group choices unchanged"""
+        images, choices = process_exam_group(self.path, self.form, self.side, chunk=2)[:2]
+        self.assertEqual(images, self.images)
+        self.assertTrue((choices == numpy.vstack([r['choices'] for r in self.records])).all())